@@ -0,0 +1,51 @@
+"""
+Compares AntiJoin with the outer merge + indicator approach deduplicate_partition used to filter files with.
+
+    python benchmarks/anti_join.py [rows] [duplicates]
+"""
+from __future__ import annotations
+
+import sys
+from timeit import timeit
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from firefly_integration.domain import AntiJoin
+
+
+def make_file(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    return pd.DataFrame({
+        'id': pd.Series(np.arange(rows)).astype(str),
+        'account': rng.choice(['a', 'b', 'c'], rows),
+        'value': rng.random(rows),
+        'updated_on': pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 86400 * 30, rows), unit='s'),
+    })
+
+
+def merge(f: pd.DataFrame, batch: pd.DataFrame, on: list):
+    return pd.merge(f, batch, indicator=True, how='outer', left_on=on, right_on=on)\
+        .query('_merge == "left_only"')\
+        .drop('_merge', axis=1)
+
+
+def main(rows: int, duplicates: int):
+    f = make_file(rows)
+    f['u'] = f['updated_on'].astype('datetime64[s]')
+    on = ['id', 'u']
+    batch = f.sample(duplicates, random_state=1)[on]
+    table = pa.Table.from_pandas(f, preserve_index=False)
+    anti_join = AntiJoin()
+
+    assert len(merge(f, batch, on)) == len(anti_join(f, batch, on)) == len(anti_join(table, batch, on))
+
+    for name, fn in (('merge', lambda: merge(f, batch, on)),
+                     ('anti join (pandas)', lambda: anti_join(f, batch, on)),
+                     ('anti join (arrow)', lambda: anti_join(table, batch, on))):
+        print(f'{name:<20} {timeit(fn, number=5) / 5:.3f}s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,45 @@
+"""
+Compares RemoveDuplicates with the sort_values + drop_duplicates approach it replaced.
+
+    python benchmarks/remove_duplicates.py [rows] [keys]
+"""
+from __future__ import annotations
+
+import sys
+from datetime import datetime
+from timeit import timeit
+
+import numpy as np
+import pandas as pd
+
+from firefly_integration.domain import RemoveDuplicates, Table, Column
+
+
+def make_frame(rows: int, keys: int) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    return pd.DataFrame({
+        'id': pd.Series(rng.integers(0, keys, rows)).astype(str),
+        'value': rng.random(rows),
+        'updated_on': pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 86400 * 30, rows), unit='s'),
+    })
+
+
+def sort_and_drop(df: pd.DataFrame, table: Table):
+    df.sort_values(table.duplicate_sort, inplace=True)
+    df.drop_duplicates(subset=table.duplicate_fields, keep='last', inplace=True)
+
+
+def main(rows: int, keys: int):
+    table = Table('events', columns=[Column('id', str), Column('value', float), Column('updated_on', datetime)],
+                  duplicate_fields=['id'], duplicate_sort=['updated_on'])
+    df = make_frame(rows, keys)
+    presorted = df.sort_values('updated_on', kind='stable')
+    remove_duplicates = RemoveDuplicates()
+
+    for name, frame in (('unsorted', df), ('sorted', presorted)):
+        for label, fn in (('sort + drop_duplicates', sort_and_drop), ('RemoveDuplicates', remove_duplicates)):
+            print(f'{name:<10} {label:<24} {timeit(lambda: fn(frame.copy(), table), number=5) / 5:.3f}s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
@@ -41,7 +41,9 @@ setuptools.setup(
     package_dir={'': 'src'},
     install_requires=[
         'firefly-framework>=1.1.54',
-        'awswrangler>=2.7.0',
+        'awswrangler>=3.0.0',
+        'pyarrow>=14.0.0',
+        'pandas>=1.5.0',
         'moz-sql-parser>=4.21',
         'graphviz>=0.16',
     ],
@@ -1,17 +1,21 @@
 from __future__ import annotations
 
 import inspect
+import os
 
 import firefly_di as di
 
 import firefly_integration.infrastructure.service.dal as dal
 from firefly_integration.domain.service.dal import Dal
 
+# Set INTEGRATION_DAL (ie: "aws" or "local") to choose an implementation. Otherwise, the first one found is used.
+dal_type = (os.environ.get('INTEGRATION_DAL') or '').lower()
 dal_class = None
 for k, v in dal.__dict__.items():
     if inspect.isclass(v) and issubclass(v, Dal):
-        dal_class = v
-        break
+        if dal_type == '' or k.lower() in (dal_type, f'{dal_type}dal'):
+            dal_class = v
+            break
 
 
 class Container(di.Container):
@@ -4,4 +4,4 @@ from .filter_parquet import FilterParquet
 from .load_data_catalogs import *
 from .map_reduce_functions import *
 from .query_data import QueryData
-from .store_data import StoreData
+from .store_data import StoreData, StoreMany, FlushWriteBuffer
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
-import awswrangler as wr
+from datetime import datetime
+from typing import List
+
 import firefly as ff
 
 import firefly_integration.domain as domain
+from firefly_integration.domain.service.dal import MAX_RUN_TIME
 
 
 @ff.command_handler()
@@ -11,8 +14,13 @@ class Compact(ff.ApplicationService):
     _dal: domain.Dal = None
     _catalog_registry: domain.CatalogRegistry = None
     _context: str = None
+    _compact_batch_size: str = None
+
+    def __init__(self):
+        if self._compact_batch_size is None:
+            self._compact_batch_size = '10'
 
-    def __call__(self, table_name: str = None, path: str = None, **kwargs):
+    def __call__(self, table_name: str = None, path: str = None, paths: List[str] = None, **kwargs):
         # Run compaction on all tables / partitions
         if table_name is None:
             for table in self._catalog_registry.get_all_tables():
@@ -29,19 +37,22 @@ class Compact(ff.ApplicationService):
             table = self._catalog_registry.get_table(table_name)
             self._dal.compact(table=table, path=path)
 
+        # Run compaction on a batch of partitions
+        elif paths is not None:
+            table = self._catalog_registry.get_table(table_name)
+            # The whole batch shares one time budget, so a single invocation never runs longer than MAX_RUN_TIME.
+            start = datetime.now()
+            for p in paths:
+                if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
+                    self.info('Out of time. The rest of the batch will be picked up on the next run.')
+                    break
+                self._dal.compact(table=table, path=p, start=start)
+
     def _scan_partitions(self, table: domain.Table):
-        path = 's3://' + table.full_path()
-        if not path.endswith('/'):
-            path += '/'
-        files = wr.s3.list_objects(path)
-        partitions = []
-        for file in files:
-            if file.endswith('.dat.snappy.parquet'):
-                continue
-            partition = '/'.join(file.split('/')[:-1])
-            if partition not in partitions:
-                partitions.append(partition)
-                self.invoke(f'{self._context}.Compact', {
-                    'table_name': table.name,
-                    'path': partition,
-                }, async_=True)
+        partitions = self._dal.get_partitions_to_compact(table)
+        batch_size = int(self._compact_batch_size)
+        for i in range(0, len(partitions), batch_size):
+            self.invoke(f'{self._context}.Compact', {
+                'table_name': table.name,
+                'paths': partitions[i:i + batch_size],
+            }, async_=True)
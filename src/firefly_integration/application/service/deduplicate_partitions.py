@@ -13,6 +13,7 @@ class DeduplicatePartitions(ff.ApplicationService):
     _dal: domain.Dal = None
     _catalog_registry: domain.CatalogRegistry = None
     _context: str = None
+    _dedup_engine: str = None
 
     def __call__(self, table_name: str = None, path: str = None, **kwargs):
         # Run deduplication on all tables
@@ -34,7 +35,7 @@ class DeduplicatePartitions(ff.ApplicationService):
                             'path': partition,
                         }, async_=True)
                         counter += 1
-                        if counter % 5 == 0:
+                        if self._dedup_engine in (None, 'athena') and counter % 5 == 0:
                             sleep(1)  # Try to avoid unnecessarily hitting the Athena query rate limit.
                 except ClientError as e:
                     self.info(str(e))
@@ -1,23 +1,52 @@
 from __future__ import annotations
 
+import uuid
 from io import StringIO
 
 import firefly as ff
 import pandas as pd
+import pyarrow as pa
+
+import firefly_integration.domain as domain
+
+RESPONSE_FORMATS = ('json', 'arrow', 'parquet')
 
 
 @ff.query_handler()
 class Map(ff.ApplicationService):
+    """
+    With response_format='json' (the default), each file is filtered through the file system and the results are
+    returned as a JSON string. The 'arrow' and 'parquet' formats read the files straight into Arrow record batches
+    and never go through JSON: 'arrow' returns the combined batches inline as a base64 IPC stream (read it with
+    domain.decode_arrow), and 'parquet' stages them with Dal.write_tmp_file and returns the tmp file, which the
+    coordinator collects with Dal.wait_for_tmp_files / Dal.read_tmp_files.
+    """
     _file_system: ff.FileSystem = None
     _batch_process: ff.BatchProcess = None
+    _dal: domain.Dal = None
     _context: str = None
     _df: pd.DataFrame = None
 
-    def __call__(self, keys: list, fields: list, criteria: dict, types: dict):
+    def __call__(self, keys: list, fields: list, criteria: dict, types: dict, response_format: str = 'json',
+                 result_file: str = None):
+        if response_format not in RESPONSE_FORMATS:
+            raise domain.UnsupportedQuery(f'Unsupported response format: {response_format}')
+
         criteria = ff.BinaryOp.from_dict(criteria)
-        results = self._batch_process(self._read, [(key[0], fields, criteria, types) for key in keys])
+        if response_format == 'json':
+            results = self._batch_process(self._read, [(key[0], fields, criteria, types) for key in keys])
+            return pd.concat(results).to_json()
 
-        return pd.concat(results).to_json()
+        results = self._batch_process(self._read_arrow, [(key[0], fields, criteria) for key in keys])
+        # Concatenating tables only collects their batches; no column data is copied.
+        data = pa.concat_tables(results, promote_options='default')
+        if response_format == 'arrow':
+            return domain.encode_arrow(data)
+
+        result_file = result_file or f'tmp/ff-map-results/{str(uuid.uuid4())}.snappy.parquet'
+        self._dal.write_tmp_file(result_file, data)
+
+        return result_file
 
     def _read(self, key: str, fields: list, criteria: ff.BinaryOp, types: dict):
         data = self._file_system.filter(key, fields, criteria)
@@ -25,3 +54,6 @@ class Map(ff.ApplicationService):
         # ret.set_index(['id'], inplace=True)
 
         return ret
+
+    def _read_arrow(self, key: str, fields: list, criteria: ff.BinaryOp) -> pa.Table:
+        return self._dal.read_files([key], fields or None, criteria)
@@ -1,17 +1,91 @@
 from __future__ import annotations
 
+import base64
+import json
+import uuid
+from hashlib import sha256
+
 import firefly as ff
 import pandas as pd
 
 import firefly_integration.domain as ffi
 
+PAGE_TTL = 3600  # 1 Hour
+RESPONSE_FORMATS = ('json', 'arrow')
+
 
 @ff.query_handler()
 class QueryData(ff.ApplicationService):
+    """
+    Returns query results as a JSON records string, or with response_format='arrow', as a base64 encoded Arrow IPC
+    stream that callers can read with ffi.decode_arrow.
+
+    With a page_size, the response is {'data': ..., 'continuation_token': ...}. Pass the token back (with the same
+    sql) for the next page; it is None on the last page. The query runs once and its result is kept in the query
+    cache, as a single entry, for PAGE_TTL seconds; each page is copied out of it. If it has been evicted, the query is
+    run again and the page is cut from the new result, so page boundaries are only stable for ordered queries.
+    """
     _catalog_registry: ffi.CatalogRegistry = None
     _query_warehouse: ffi.QueryWarehouse = None
+    _query_cache: ffi.QueryCache = None
+
+    def __call__(self, sql: str, page_size: int = None, continuation_token: str = None, response_format: str = 'json',
+                 **kwargs):
+        if response_format not in RESPONSE_FORMATS:
+            raise ffi.UnsupportedQuery(f'Unsupported response format: {response_format}')
+
+        if page_size is None and continuation_token is None:
+            ret: pd.DataFrame = self._query_warehouse(sql)
+            return self._serialize(ret, response_format)
+
+        key, offset = None, 0
+        if continuation_token is not None:
+            key, offset, page_size = self._decode_token(continuation_token, sql)
+        page_size = int(page_size)
+        if page_size < 1:
+            raise ffi.UnsupportedQuery('page_size must be positive')
+
+        # Each page carries the first row of the next one, so we know if it's the last.
+        rows = slice(offset, offset + page_size + 1)
+        page = self._query_cache.get(key, PAGE_TTL, rows=rows) if key is not None else None
+        if page is None:
+            key, results = self._paginate(sql, page_size)
+            page = results.iloc[rows]
+
+        has_more = len(page) > page_size
+        return {
+            'data': self._serialize(page.iloc[:page_size], response_format),
+            'continuation_token': self._encode_token(sql, key, offset + page_size, page_size) if has_more else None,
+        }
+
+    def _paginate(self, sql: str, page_size: int):
+        results: pd.DataFrame = self._query_warehouse(sql).reset_index(drop=True)
+        key = str(uuid.uuid4())
+        if len(results) > page_size:
+            self._query_cache.put(key, results)
+
+        return key, results
+
+    @staticmethod
+    def _serialize(df: pd.DataFrame, response_format: str):
+        if response_format == 'json':
+            return df.to_json(orient='records')
+
+        return ffi.encode_arrow(df)
+
+    @staticmethod
+    def _encode_token(sql: str, key: str, offset: int, page_size: int) -> str:
+        token = {'q': sha256(sql.encode('utf-8')).hexdigest()[:16], 'k': key, 'o': offset, 's': page_size}
+        return base64.urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('ascii')
 
-    def __call__(self, sql: str, **kwargs):
-        ret: pd.DataFrame = self._query_warehouse(sql)
+    @staticmethod
+    def _decode_token(token: str, sql: str):
+        try:
+            token = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+            key, offset, page_size = token['k'], int(token['o']), int(token['s'])
+        except (ValueError, TypeError, KeyError):
+            raise ffi.InvalidContinuationToken()
+        if token.get('q') != sha256(sql.encode('utf-8')).hexdigest()[:16]:
+            raise ffi.InvalidContinuationToken('The continuation token belongs to a different query')
 
-        return ret.to_json(orient='records')
+        return key, offset, page_size
@@ -9,5 +9,27 @@ class StoreData(ff.ApplicationService):
     _catalog_registry: ffi.CatalogRegistry = None
     _store_data: ffi.StoreData = None
 
-    def __call__(self, data, table: str, **kwargs):
-        return self._store_data(data, self._catalog_registry.get_table(table))
+    def __call__(self, data, table: str, buffered: bool = None, **kwargs):
+        return self._store_data(data, self._catalog_registry.get_table(table), buffered=buffered)
+
+
+@ff.command_handler()
+class StoreMany(ff.ApplicationService):
+    _catalog_registry: ffi.CatalogRegistry = None
+    _store_data: ffi.StoreData = None
+
+    def __call__(self, data: dict, buffered: bool = None, **kwargs):
+        failures = self._store_data.store_many(
+            {self._catalog_registry.get_table(k): v for k, v in data.items()}, buffered=buffered
+        )
+
+        return {k: str(v) for k, v in failures.items()}
+
+
+@ff.command_handler()
+class FlushWriteBuffer(ff.ApplicationService):
+    _catalog_registry: ffi.CatalogRegistry = None
+    _store_data: ffi.StoreData = None
+
+    def __call__(self, table: str = None, **kwargs):
+        self._store_data.flush(self._catalog_registry.get_table(table) if table is not None else None)
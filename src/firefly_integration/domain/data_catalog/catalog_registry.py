@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import firefly as ff
 import firefly_integration.domain as domain
@@ -8,9 +8,12 @@ import firefly_integration.domain as domain
 
 class CatalogRegistry(ff.DomainService):
     _catalogs: List[domain.Catalog] = []
+    _tables: Dict[str, domain.Table] = {}
+    _revision: Optional[int] = None
 
     def add_catalog(self, catalog: domain.Catalog):
         self._catalogs.append(catalog)
+        self._index()
 
     def get_all_tables(self) -> List[domain.Table]:
         ret = []
@@ -22,8 +25,17 @@ class CatalogRegistry(ff.DomainService):
         return ret
 
     def get_table(self, table_name: str) -> Optional[domain.Table]:
-        for catalog in self._catalogs:
-            for database in catalog.databases:
-                for table in database.tables:
-                    if table.name == table_name:
-                        return table
+        if not isinstance(table_name, str):
+            return None
+
+        # Tables may have been added to a database after its catalog was registered.
+        if self._revision != domain.Database.revision:
+            self._index()
+        return self._tables.get(table_name)
+
+    def _index(self):
+        tables = {}
+        for table in self.get_all_tables():
+            tables.setdefault(table.name, table)
+        CatalogRegistry._tables = tables
+        CatalogRegistry._revision = domain.Database.revision
@@ -3,6 +3,7 @@ from __future__ import annotations
 from datetime import datetime, date
 
 import pandas as pd
+import pyarrow as pa
 
 import firefly_integration.domain as domain
 
@@ -14,13 +15,14 @@ class NoDefault:
 
 
 class Column:
-    name: str = None
-    data_type: type = None
-    description: str = None
-    required: bool = False
-    default = NoDefault
-    meta: dict = {}
-    table: domain.Table = None
+    __slots__ = ('name', 'data_type', 'description', 'required', 'default', 'meta', 'table')
+
+    name: str
+    data_type: type
+    description: str
+    required: bool
+    meta: dict
+    table: domain.Table
 
     def __init__(self, name: str, data_type: type, description: str = None, required: bool = False, default=NoDefault,
                  meta: dict = None):
@@ -35,6 +37,7 @@ class Column:
         self.required = required
         self.default = default
         self.meta = meta or {}
+        self.table = None
 
     def set_type(self, df: pd.DataFrame):
         df[self.name].astype(str(self.data_type), inplace=True)
@@ -49,3 +52,19 @@ class Column:
         else:
             return self.data_type
 
+    @property
+    def arrow_type(self):
+        if self.data_type is int or self.data_type == 'int':
+            return pa.int64()
+        elif self.data_type is str:
+            return pa.string()
+        elif self.data_type is float:
+            return pa.float64()
+        elif self.data_type is bool:
+            return pa.bool_()
+        elif self.data_type is datetime:
+            return pa.timestamp('ns')
+        elif self.data_type is date:
+            return pa.date32()
+        else:
+            return pa.string()
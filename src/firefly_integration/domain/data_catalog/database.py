@@ -9,7 +9,7 @@ class Database:
     name: str = None
     path: str = None
     description: str = None
-    tables: List[domain.Table] = []
+    revision: int = 0  # Bumped whenever any database's tables are replaced
 
     def __init__(self, name: str, path: str, tables: List[domain.Table], description: str = None):
         self.name = name
@@ -20,7 +20,17 @@ class Database:
         for table in self.tables:
             table.database = self
 
-    def get_table(self, name: str):
-        ret = list(filter(lambda x: x.name == name, self.tables))
+    @property
+    def tables(self) -> List[domain.Table]:
+        return self._tables
+
+    @tables.setter
+    def tables(self, tables: List[domain.Table]):
+        self._tables = tables
+        Database.revision += 1
+        self._tables_by_name = {}
+        for table in tables:
+            self._tables_by_name.setdefault(table.name, table)
 
-        return None if len(ret) == 0 else ret[0]
+    def get_table(self, name: str):
+        return self._tables_by_name.get(name)
@@ -2,18 +2,20 @@ from __future__ import annotations
 
 import uuid
 from datetime import datetime, date
-from typing import List, Dict, Callable
+from typing import List, Dict, Callable, Iterator, Tuple, Union
 
 import pandas as pd
+import pyarrow as pa
 
 import firefly_integration.domain as domain
 
+TIME_UNITS = {'year': 'Y', 'month': 'M', 'day': 'D'}
+
 
 class Table:
     name: str = None
     path: str = None
     description: str = None
-    columns: List[domain.Column] = []
     partitions: List[str] = []
     duplicate_fields: List[str] = []
     duplicate_sort: List[str] = []
@@ -23,11 +25,16 @@ class Table:
     time_partitioning_column: str = None
     file_name: Callable = None
     _partition_generators: Dict[str, Callable] = None
+    _columnar_partition_generators: Dict[str, Callable] = None
+    projected_values: Dict[str, Union[list, range, Callable]] = None
+    time_partitioning_start: str = None
 
     def __init__(self, name: str, columns: List[domain.Column], partitions: List[str] = None, path: str = '',
                  description: str = None, duplicate_fields: List[str] = None, duplicate_sort: List[str] = None,
                  partition_generators: Dict[str, Callable] = None, date_grouping: dict = None,
-                 file_name: Callable = None, time_partitioning: str = None, time_partitioning_column: str = None):
+                 file_name: Callable = None, time_partitioning: str = None, time_partitioning_column: str = None,
+                 columnar_partition_generators: Dict[str, Callable] = None,
+                 projected_values: Dict[str, Union[list, range, Callable]] = None, time_partitioning_start: str = None):
         self.name = name
         self.path = path
         self.columns = columns
@@ -36,6 +43,9 @@ class Table:
         self.duplicate_fields = duplicate_fields
         self.duplicate_sort = duplicate_sort or []
         self._partition_generators = partition_generators
+        self._columnar_partition_generators = columnar_partition_generators
+        self.projected_values = projected_values
+        self.time_partitioning_start = time_partitioning_start
         self.date_grouping = date_grouping
         self.file_name = file_name
         self.time_partitioning = time_partitioning
@@ -44,11 +54,28 @@ class Table:
         for column in self.columns:
             column.table = self
 
+    @property
+    def columns(self) -> List[domain.Column]:
+        return self._columns
+
+    @columns.setter
+    def columns(self, columns: List[domain.Column]):
+        # Columns are treated as immutable once they belong to a table, so everything derived from them is computed
+        # once here (or on first use) instead of on every access.
+        self._columns = columns
+        self._columns_by_name = {c.name: c for c in columns}
+        self._type_dict = None
+        self._pandas_dtypes = None
+        self._arrow_schema = None
+
     def get_column(self, name: str):
-        for column in self.columns:
-            if column.name == name:
-                return column
-        raise domain.ColumnNotFound(name)
+        try:
+            return self._columns_by_name[name]
+        except KeyError:
+            raise domain.ColumnNotFound(name)
+
+    def has_column(self, name: str):
+        return name in self._columns_by_name
 
     def generate_partition_path(self, data: pd.DataFrame):
         parts = []
@@ -64,12 +91,111 @@ class Table:
         return '/'.join(parts)
 
     @property
-    def type_dict(self):
-        ret = {}
-        for column in self.columns:
-            ret[column.name] = self._pandas_type(column.data_type)
+    def partition_names(self) -> List[str]:
+        ret = [p for p in self.partitions if p != 'dt' or self.time_partitioning is None]
+        if self.time_partitioning is not None:
+            ret.append('dt')
+
         return ret
 
+    @property
+    def projection_enabled(self) -> bool:
+        """
+        True when every partition's possible values are declared: a list (or a callable returning one) or a range per
+        partition in projected_values, and a time_partitioning_start if the table is time partitioned.
+        """
+        if len(self.partition_names) == 0:
+            return False
+        if any(p not in (self.projected_values or {}) for p in self.partition_names if p != 'dt'):
+            return False
+
+        return self.time_partitioning is None or self.time_partitioning_start is not None
+
+    def projected_partition_values(self, name: str) -> Union[list, range]:
+        values = self.projected_values[name]
+        if callable(values):
+            values = values()
+
+        return values if isinstance(values, range) else list(values)
+
+    def partition_values(self, df: Union[pd.DataFrame, pa.Table]) -> pd.DataFrame:
+        """
+        The partition values (and dt) of every row, as categoricals. Columnar generators are given the whole frame and
+        return a Series; per-row generators still work but are applied one row at a time.
+        """
+        if isinstance(df, pa.Table):
+            if self._partition_generators or self._columnar_partition_generators:
+                df = df.to_pandas()
+            else:
+                names = [p for p in self.partitions if p != 'dt'] + [self.time_partitioning_column]
+                df = df.select([n for n in dict.fromkeys(names) if n in df.column_names]).to_pandas()
+
+        ret = {}
+        for name in self.partition_names:
+            if name == 'dt':
+                if self.time_partitioning_column not in df:
+                    raise domain.InvalidPartitionData()
+                values = self.time_partition_values(df[self.time_partitioning_column])
+            elif self._columnar_partition_generators is not None and name in self._columnar_partition_generators:
+                values = pd.Series(self._columnar_partition_generators[name](df), index=df.index)
+            elif self._partition_generators is not None and name in self._partition_generators:
+                values = df.apply(self._partition_generators[name], axis=1)
+            elif name in df:
+                values = df[name]
+            else:
+                raise domain.InvalidPartitionData()
+            ret[name] = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+
+        return pd.DataFrame(ret, index=df.index)
+
+    def partition_groups(self, df: pd.DataFrame) -> Iterator[Tuple[tuple, pd.DataFrame]]:
+        """
+        Splits df into one frame per partition with a single groupby over the categorical partition values. Yields the
+        partition values (in partition_names order, None for nulls) and the rows.
+        """
+        keys = self.partition_values(df)
+        if len(keys.columns) == 0:
+            yield (), df
+            return
+
+        groups = keys.groupby(list(keys.columns), sort=False, observed=True, dropna=False).indices
+        for values, rows in groups.items():
+            values = values if isinstance(values, tuple) else (values,)
+            yield tuple(None if pd.isna(v) else v for v in values), df if len(groups) == 1 else df.iloc[rows]
+
+    def time_partition_values(self, values: pd.Series) -> pd.Series:
+        """
+        The dt value for each timestamp. Timestamps are floored to the partitioning period with a datetime64 cast and
+        only the distinct periods are formatted, so there is one string per period rather than one per row.
+        """
+        if not pd.api.types.is_datetime64_dtype(values):
+            values = pd.to_datetime(values)
+            if getattr(values.dt, 'tz', None) is not None:
+                values = values.dt.tz_localize(None)
+        periods = values.values.astype(f'datetime64[{TIME_UNITS.get(self.time_partitioning, "Y")}]')
+        codes, uniques = pd.factorize(periods)
+        categories = pd.DatetimeIndex(uniques.astype('datetime64[s]')).strftime(self.time_partition_format)
+
+        return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=values.index, name='dt')
+
+    @property
+    def type_dict(self):
+        if self._type_dict is None:
+            self._type_dict = {column.name: self._pandas_type(column.data_type) for column in self.columns}
+        return self._type_dict
+
+    @property
+    def pandas_dtypes(self):
+        if self._pandas_dtypes is None:
+            self._pandas_dtypes = {column.name: column.pandas_type for column in self.columns}
+        return self._pandas_dtypes
+
+    @property
+    def arrow_schema(self) -> pa.Schema:
+        if self._arrow_schema is None:
+            self._arrow_schema = pa.schema([pa.field(column.name, column.arrow_type) for column in self.columns])
+        return self._arrow_schema
+
     def full_path(self, df: pd.DataFrame = None):
         ret = f'{self.database.path}/{self.path or ""}'.rstrip('/')
         ret = f'{ret}/{self.name}'
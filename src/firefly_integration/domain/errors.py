@@ -24,3 +24,11 @@ class InvalidPartitionData(IntegrationError):
 
 class WorkflowFunctionError(IntegrationError):
     pass
+
+
+class UnsupportedQuery(IntegrationError):
+    pass
+
+
+class InvalidContinuationToken(IntegrationError):
+    pass
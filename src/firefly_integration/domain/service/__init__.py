@@ -1,7 +1,11 @@
+from .anti_join import AntiJoin
+from .arrow_transport import encode_arrow, decode_arrow
 from .dal import Dal
 from .marshal_dataframe import MarshalDataframe
+from .query_cache import QueryCache
 from .query_warehouse import *
 from .remove_duplicates import RemoveDuplicates
 from .sanitize_input_data import SanitizeInputData
-from .sql_parser import SqlParser
+from .sql_parser import SqlParser, ParsedQuery
 from .store_data import StoreData
+from .write_buffer import WriteBuffer
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from typing import List, Optional, Union
+
+import firefly as ff
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class AntiJoin(ff.DomainService):
+    """
+    Returns the rows of data whose values in the `on` columns don't appear in remove. Each key column is narrowed
+    with a membership test against the keys to remove, and only the rows that survive every column are compared by a
+    hash of the whole key. No joined result is ever built. Null keys never match.
+    """
+
+    def __call__(self, data: Union[pd.DataFrame, pa.Table], remove: Union[pd.DataFrame, pa.Table],
+                 on: List[str]) -> Union[pd.DataFrame, pa.Table]:
+        if len(remove) == 0 or len(data) == 0:
+            return data
+
+        mask = self.mask(data, remove, on)
+        if isinstance(data, pa.Table):
+            return data.filter(pa.array(mask))
+
+        return data[mask]
+
+    def mask(self, data: Union[pd.DataFrame, pa.Table], remove: Union[pd.DataFrame, pa.Table],
+             on: List[str]) -> np.ndarray:
+        """
+        Returns a boolean array that is True for the rows of data to keep.
+        """
+        keep = np.ones(len(data), dtype=bool)
+        right = self._keys(remove, on).dropna()
+        if len(right) == 0:
+            return keep
+
+        candidates = np.arange(len(data))
+        for name in on:
+            candidates = candidates[self._isin(data, name, candidates, right[name])]
+            if len(candidates) == 0:
+                return keep
+
+        left = self._keys(data, on, candidates)
+        right = right.astype(left.dtypes.to_dict())
+        keep[candidates] = ~np.isin(
+            pd.util.hash_pandas_object(left, index=False).values, pd.util.hash_pandas_object(right, index=False).values
+        )
+
+        return keep
+
+    def _isin(self, data: Union[pd.DataFrame, pa.Table], name: str, rows: np.ndarray, values: pd.Series) -> np.ndarray:
+        if isinstance(data, pa.Table):
+            column = data.column(name)
+            if len(rows) < len(data):
+                column = column.take(pa.array(rows))
+            try:
+                value_set = pa.array(values, from_pandas=True).cast(column.type, safe=False)
+                return pc.is_in(column, value_set=value_set).to_numpy(zero_copy_only=False)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+                series = self._normalize(column.to_pandas())
+        else:
+            series = data[name]
+            if len(rows) < len(data):
+                series = series.iloc[rows]
+            series = self._normalize(series)
+
+        return series.isin(values).values
+
+    def _keys(self, data: Union[pd.DataFrame, pa.Table], on: List[str], rows: Optional[np.ndarray] = None):
+        if isinstance(data, pa.Table):
+            data = data.select(on)
+            if rows is not None:
+                data = data.take(pa.array(rows))
+            keys = data.to_pandas()
+        else:
+            keys = data[on] if rows is None else data[on].iloc[rows]
+            keys = keys.reset_index(drop=True)
+
+        return pd.DataFrame({name: self._normalize(keys[name]) for name in on})
+
+    @staticmethod
+    def _normalize(series: pd.Series) -> pd.Series:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return pd.to_datetime(series).dt.tz_localize(None).astype('datetime64[ns]')
+
+        return series.reset_index(drop=True)
@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+import base64
+from typing import Union
+
+import pandas as pd
+import pyarrow as pa
+
+
+def encode_arrow(data: Union[pd.DataFrame, pa.Table]) -> str:
+    """
+    Serializes a table as an Arrow IPC stream, base64 encoded so it can travel in a JSON message.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, preserve_index=False)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, data.schema) as writer:
+        writer.write_table(data)
+
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode('ascii')
+
+
+def decode_arrow(payload: Union[str, bytes]) -> pa.Table:
+    """
+    Reads a table produced by encode_arrow. The batches reference the decoded buffer directly, without copying.
+    """
+    return pa.ipc.open_stream(pa.py_buffer(base64.b64decode(payload))).read_all()
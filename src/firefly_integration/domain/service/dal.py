@@ -1,21 +1,49 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Union, Dict
 
 import firefly as ff
 import pandas as pd
+import pyarrow as pa
 
 from ..data_catalog.table import Table
 
+MAX_FILE_SIZE = 262144000  # 250MB
+MAX_RUN_TIME = 600  # 10 Minutes
+PARTITION_LOCK = 'partition-lock-{}'
+
 
 class Dal(ABC):
     @abstractmethod
-    def store(self, data: pd.DataFrame, table: Table):
+    def store(self, data: Union[pd.DataFrame, pa.Table], table: Table):
+        """
+        Accepts either a DataFrame or a pyarrow Table. Arrow input is written without a round-trip through pandas.
+        """
         pass
 
+    def store_many(self, data: Dict[Table, Union[pd.DataFrame, pa.Table]],
+                   max_workers: int = 4) -> Dict[str, Exception]:
+        """
+        Stores several tables concurrently and returns once every write has finished. A failing table doesn't stop the
+        others; failures are returned keyed by table name.
+        """
+        if len(data) == 0:
+            return {}
+
+        def store(item):
+            try:
+                self.store(item[1], item[0])
+            except Exception as e:
+                return item[0].name, e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(data), max_workers))) as executor:
+            return dict(filter(None, executor.map(store, data.items())))
+
     @abstractmethod
-    def load(self, table: Table, criteria: ff.BinaryOp = None) -> pd.DataFrame:
+    def load(self, table: Table, criteria: ff.BinaryOp = None, columns: List[str] = None) -> pd.DataFrame:
         pass
 
     @abstractmethod
@@ -26,6 +54,21 @@ class Dal(ABC):
     def get_partitions(self, table: Table, criteria: ff.BinaryOp = None) -> List[str]:
         pass
 
+    @abstractmethod
+    def get_fingerprint(self, table: Table, criteria: ff.BinaryOp = None) -> str:
+        """
+        Returns a hash that changes whenever the files that could match the criteria change.
+        """
+        pass
+
+    @abstractmethod
+    def read_files(self, files: List[str], columns: List[str] = None, criteria: ff.BinaryOp = None) -> pa.Table:
+        """
+        Reads individual parquet files (full object paths, with or without a scheme) into one Arrow table, keeping only
+        the rows that match the criteria.
+        """
+        pass
+
     @abstractmethod
     def wait_for_tmp_files(self, files: list):
         pass
@@ -35,11 +78,22 @@ class Dal(ABC):
         pass
 
     @abstractmethod
-    def write_tmp_file(self, file: str, data: pd.DataFrame):
+    def write_tmp_file(self, file: str, data: Union[pd.DataFrame, pa.Table]):
+        pass
+
+    @abstractmethod
+    def get_partitions_to_compact(self, table: Table) -> List[str]:
+        """
+        Returns the partitions (or the table path, for unpartitioned tables) that contain files other than master files.
+        """
         pass
 
     @abstractmethod
-    def compact(self, table: Table, path: str):
+    def compact(self, table: Table, path: str, start: datetime = None):
+        """
+        Stops starting new work MAX_RUN_TIME seconds after start (by default, when the call began), so a caller
+        compacting several partitions can share one time budget across them.
+        """
         pass
 
     @abstractmethod
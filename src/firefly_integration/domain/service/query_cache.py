@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import os
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import Optional
+
+import firefly as ff
+import pandas as pd
+
+
+class QueryCache(ff.DomainService):
+    """
+    Two-tier cache for query results. Keys are expected to include a fingerprint of the files a query read, so a new
+    write produces a new key rather than a stale hit. Old entries simply age out of the LRU, which is bounded by both
+    _query_cache_size entries and _query_cache_bytes of memory.
+    """
+    _query_cache_size: str = None
+    _query_cache_bytes: str = None
+    _query_cache_dir: str = None
+    _query_cache_disk_bytes: str = None
+
+    def __init__(self):
+        if self._query_cache_size is None:
+            self._query_cache_size = '256'
+        if self._query_cache_bytes is None:
+            self._query_cache_bytes = str(512 * 1024 ** 2)
+        if self._query_cache_disk_bytes is None:
+            self._query_cache_disk_bytes = str(1024 ** 3)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key: str, max_age: int = None, rows: slice = None) -> Optional[pd.DataFrame]:
+        """
+        With rows, only that slice of the cached frame is copied and returned.
+        """
+        rows = rows or slice(None)
+        with self._lock:
+            if key in self._entries:
+                created_on, df, size = self._entries[key]
+                if max_age is None or time() - created_on <= max_age:
+                    self._entries.move_to_end(key)
+                    return df.iloc[rows].copy()
+                del self._entries[key]
+                self._bytes -= size
+
+        df = self._read_from_disk(key, max_age)
+        if df is not None:
+            self._put_in_memory(key, df, time())
+            return df.iloc[rows].copy()
+
+    def put(self, key: str, df: pd.DataFrame):
+        now = time()
+        self._put_in_memory(key, df.copy(), now)
+        self._write_to_disk(key, df)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _put_in_memory(self, key: str, df: pd.DataFrame, created_on: float):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[2]
+            if size > int(self._query_cache_bytes):
+                return  # Too big to keep in memory; it only lives on disk
+            self._entries[key] = (created_on, df, size)
+            self._bytes += size
+            while len(self._entries) > int(self._query_cache_size) or self._bytes > int(self._query_cache_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+
+    def _read_from_disk(self, key: str, max_age: int = None) -> Optional[pd.DataFrame]:
+        if self._query_cache_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            if max_age is not None and time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                return None
+            df = pd.read_parquet(path)
+            os.utime(path, (time(), os.path.getmtime(path)))
+        except (FileNotFoundError, OSError):
+            return None
+
+        return df
+
+    def _write_to_disk(self, key: str, df: pd.DataFrame):
+        if self._query_cache_dir is None:
+            return
+
+        os.makedirs(self._query_cache_dir, exist_ok=True)
+        path = self._disk_path(key)
+        try:
+            df.to_parquet(f'{path}.tmp', compression='snappy')
+            os.replace(f'{path}.tmp', path)
+        except (ValueError, TypeError, OSError) as e:
+            self.info(f'Could not cache query results: {str(e)}')
+            return
+
+        self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        entries = []
+        for entry in os.scandir(self._query_cache_dir):
+            if entry.is_file() and entry.name.endswith('.parquet'):
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(map(lambda e: e[1], entries))
+        for _, size, path in sorted(entries):
+            if total <= int(self._query_cache_disk_bytes):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _disk_path(self, key: str):
+        return os.path.join(self._query_cache_dir, f'{key}.parquet')
@@ -3,14 +3,21 @@ from __future__ import annotations
 import multiprocessing
 import uuid
 from datetime import date, datetime
-from typing import Optional
+from hashlib import sha256
+from typing import Optional, Iterator
 
 import firefly as ff
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
 
 import firefly_integration.domain as domain
 import awswrangler as wr
 
+EXPORT_FORMATS = ('ndjson', 'csv', 'parquet')
+
 
 class QueryWarehouse(ff.DomainService):
     _catalog_registry: domain.CatalogRegistry = None
@@ -18,75 +25,305 @@ class QueryWarehouse(ff.DomainService):
     _batch_process: ff.BatchProcess = None
     _filter_parquet: FilterParquet = None
     _remove_duplicates: domain.RemoveDuplicates = None
+    _query_cache: domain.QueryCache = None
     _dal: domain.Dal = None
     _file_system: ff.FileSystem = None
     _ff_environment: str = None
+    _query_engine: str = None
+    _export_chunk_size: str = None
 
     def __init__(self):
         self._cpu_count = multiprocessing.cpu_count()
         self._threshold = self._cpu_count
+        if self._query_engine is None:
+            self._query_engine = 'athena'
+        if self._export_chunk_size is None:
+            self._export_chunk_size = '100000'
 
     def __call__(self, sql: str, table: domain.Table = None, output_file: str = None,
-                 cache_seconds: int = None) -> Optional[pd.DataFrame]:
-        # This is temporary code to get warehouse queries working. This uses athena. We either need to move this
-        # code, specifically the aws wrangler part, to an infrastructure class or finish the original approach using
-        # lambda. Also, the database name is assumed here, and it shouldn't be.
-        self._sql_parser.parse(sql)
+                 cache_seconds: int = None, output_format: str = None) -> Optional[pd.DataFrame]:
+        if output_file is not None and output_format is not None:
+            self.export(sql, output_file, output_format, table, cache_seconds)
+            return
+
+        query = self._sql_parser.parse(sql)
+        if table is None:
+            table: domain.Table = self._catalog_registry.get_table(query.get_table())
+
+        results = None
+        cache_key = None
+        if cache_seconds is not None and table is not None:
+            cache_key = self._cache_key(query, table)
+            results = self._query_cache.get(cache_key, cache_seconds)
+
+        if results is None:
+            if self._query_engine == 'native':
+                try:
+                    results = self._query_parquet(query, table)
+                except domain.UnsupportedQuery as e:
+                    self.debug(f'Falling back to Athena: {str(e)}')
+
+            if results is None:
+                results = self._query_athena(query, table, cache_seconds)
+
+            # Only fresh results are cached; putting a hit back would reset its age so it never expires.
+            if cache_key is not None:
+                self._query_cache.put(cache_key, results)
+
+        if output_file is not None:
+            if not output_file.startswith('s3://'):
+                output_file = f's3://{output_file}'
+            self._format_dates(results, table)
+            wr.s3.to_json(df=results, path=output_file, use_threads=True)
+        else:
+            return results
+
+    def export(self, sql: str, output_file: str, output_format: str = 'ndjson', table: domain.Table = None,
+               cache_seconds: int = None) -> int:
+        """
+        Streams the results of a query to output_file as NDJSON, CSV or Parquet, _export_chunk_size rows at a time,
+        through a multipart upload. Athena results are read chunk by chunk, so memory is bounded by the chunk size.
+        That doesn't hold for the native engine, which returns its whole result at once, or for tables with
+        duplicate_fields, whose results have to be de-duplicated as a whole first. Those results are loaded in full
+        and only written in chunks. Returns the number of rows written.
+        """
+        if output_format not in EXPORT_FORMATS:
+            raise domain.UnsupportedQuery(f'Unsupported export format: {output_format}')
+
+        query = self._sql_parser.parse(sql)
         if table is None:
-            table: domain.Table = self._catalog_registry.get_table(self._sql_parser.get_table())
+            table: domain.Table = self._catalog_registry.get_table(query.get_table())
+        if '://' not in output_file:
+            output_file = f's3://{output_file}'
 
+        filesystem, path = fs.FileSystem.from_uri(output_file)
+        rows = 0
+        writer = None
+        header_written = False
+        with filesystem.open_output_stream(path) as stream:
+            for chunk in self._result_chunks(query, table, cache_seconds):
+                if output_format == 'parquet':
+                    if writer is None:
+                        writer = pq.ParquetWriter(stream, self._export_schema(chunk, table), compression='snappy')
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
+                else:
+                    self._format_dates(chunk, table)
+                    if output_format == 'csv':
+                        text = chunk.to_csv(index=False, header=not header_written)
+                        header_written = True
+                    else:
+                        text = chunk.to_json(orient='records', lines=True)
+                        text = text if text.endswith('\n') or len(text) == 0 else f'{text}\n'
+                    stream.write(text.encode('utf-8'))
+                rows += len(chunk)
+            if writer is not None:
+                writer.close()
+
+        return rows
+
+    def _result_chunks(self, query: domain.ParsedQuery, table: domain.Table,
+                       cache_seconds: int = None) -> Iterator[pd.DataFrame]:
+        size = int(self._export_chunk_size)
+        results = None
+        if self._query_engine == 'native':
+            try:
+                results = self._query_parquet(query, table)
+            except domain.UnsupportedQuery as e:
+                self.debug(f'Falling back to Athena: {str(e)}')
+
+        if results is None and (table is None or not table.duplicate_fields):
+            params = self._athena_params(query, cache_seconds)
+            params['chunksize'] = size
+            yield from ff.retry(lambda: wr.athena.read_sql_query(**params))
+            return
+
+        if results is None:
+            results = self._query_athena(query, table, cache_seconds)
+        for start in range(0, len(results), size):
+            yield results.iloc[start:start + size].copy()
+
+    @staticmethod
+    def _export_schema(chunk: pd.DataFrame, table: Optional[domain.Table]) -> pa.Schema:
+        # Types inferred from the first chunk alone break on a column that happens to be all null there, so the
+        # table's types win for every column it knows about.
+        ret = pa.Schema.from_pandas(chunk, preserve_index=False)
+        if table is None:
+            return ret
+        known = {f.name: f for f in table.arrow_schema}
+
+        return pa.schema([known.get(f.name, f) for f in ret])
+
+    @staticmethod
+    def _format_dates(results: pd.DataFrame, table: Optional[domain.Table]):
+        # Arrow formats the whole column at once; the regex drops the fraction from whole seconds, like isoformat().
+        if table is None:
+            return
+        for column in table.columns:
+            if column.data_type not in (date, datetime) or column.name not in results:
+                continue
+            values = results[column.name]
+            if column.data_type is datetime or pd.api.types.is_datetime64_any_dtype(values):
+                values = pd.to_datetime(values)
+                if values.dt.tz is not None:
+                    values = values.dt.tz_localize(None)
+                array = pa.array(values.values.astype('datetime64[us]'), mask=values.isna().values)
+                array = pc.replace_substring(array.cast(pa.string()), ' ', 'T', max_replacements=1)
+                array = pc.replace_substring_regex(array, r'\.0+$', '')
+            else:
+                array = pa.array(values, from_pandas=True, type=pa.date32()).cast(pa.string())
+            results[column.name] = array.to_numpy(zero_copy_only=False)
+
+    def _query_athena(self, query: domain.ParsedQuery, table: domain.Table, cache_seconds: int = None) -> pd.DataFrame:
+        # This uses athena. We either need to move this code, specifically the aws wrangler part, to an
+        # infrastructure class or finish the original approach using lambda. Also, the database name is assumed here,
+        # and it shouldn't be.
+        params = self._athena_params(query, cache_seconds)
+        results = ff.retry(lambda: wr.athena.read_sql_query(**params))
+
+        try:
+            self._remove_duplicates(results, table)
+            self._sort(query, results)
+        except KeyError:
+            pass
+
+        return results
+
+    def _athena_params(self, query: domain.ParsedQuery, cache_seconds: int = None) -> dict:
         params = {
-            'sql': sql,
+            'sql': query.sql,
             'database': f'data_warehouse_{self._ff_environment}',
             'ctas_approach': False,
             'use_threads': True,
         }
 
         if cache_seconds is not None:
-            params['max_cache_seconds'] = cache_seconds
+            params['athena_cache_settings'] = {'max_cache_seconds': cache_seconds}
 
-        results = ff.retry(lambda: wr.athena.read_sql_query(
-            sql=sql,
-            database=f'data_warehouse_{self._ff_environment}',
-            ctas_approach=False,
-            use_threads=True
-        ))
+        return params
+
+    def _query_parquet(self, query: domain.ParsedQuery, table: domain.Table) -> pd.DataFrame:
+        """
+        Runs the query in-process, straight over the table's parquet files. Partition pruning, projection and
+        predicate push-down are handled by the Dal, so only the row groups that can match are ever read.
+        """
+        for clause in query.get_clauses():
+            if clause not in ('select', 'from', 'where', 'orderby', 'limit'):
+                raise domain.UnsupportedQuery(f'Unsupported clause: {clause}')
+        if table is None:
+            raise domain.UnsupportedQuery(f'Unknown table: {query.get_table()}')
+        source = query.get_from()
+        if not isinstance(source, str) and not (
+                isinstance(source, dict) and set(source.keys()) <= {'value', 'name'} and
+                isinstance(source.get('value'), str)):
+            raise domain.UnsupportedQuery(f'Unsupported from clause: {source}')
+
+        criteria = query.get_criteria()
+        if criteria is not None:
+            criteria = self._coerce_criteria(ff.BinaryOp.from_dict(criteria), table)
 
+        fields = self._get_select_fields(query)
+        sort_fields = query.get_sort_order()[0] if 'orderby' in query.get_clauses() else []
+        # Anything that isn't one of the table's own columns (alias qualified names, columns of another table) is
+        # left to Athena.
+        for name in list((fields or {}).keys()) + self._criteria_attributes(criteria) + sort_fields:
+            if not self._has_column(table, name):
+                raise domain.UnsupportedQuery(f'Unknown column: {name}')
+        columns = None
+        if fields is not None:
+            columns = []
+            for name in list(fields.keys()) + (table.duplicate_fields or []) + table.duplicate_sort + sort_fields:
+                if name not in columns and self._has_column(table, name):
+                    columns.append(name)
+
+        results = self._dal.load(table, criteria, columns)
         try:
             self._remove_duplicates(results, table)
-            self._sort(results)
+            self._sort(query, results)
         except KeyError:
             pass
 
-        if output_file is not None:
-            if not output_file.startswith('s3://'):
-                output_file = f's3://{output_file}'
-            for column in table.columns:
-                if column.data_type in (date, datetime) and column.name in results:
-                    results[column.name] = results[column.name].apply(lambda x: x if x is None else x.isoformat())
-            wr.s3.to_json(df=results, path=output_file, use_threads=True)
-        else:
-            return results
+        limit = query.get_limit()
+        if limit is not None:
+            results = results.head(limit)
+
+        if fields is not None:
+            results = results[list(fields.keys())].rename(columns=fields)
+
+        return results.reset_index(drop=True)
 
-        # partition_criteria, select_criteria = self._process_criteria(table)
-        # paths = self._dal.get_partitions(table, partition_criteria)
-        # if len(paths) == 0:
-        #     return None
-        #
-        # files = self._batch_process(self._list_files, [(path,) for path in paths])
-        # files = [item for sb in files for item in sb]
-        #
-        # fields = self._sql_parser.get_select_fields()
-        # if len(files) <= self._threshold:
-        #     results = self._batch_process(self._filter_parquet, [(file, fields, select_criteria) for file in files])
-        #     results = pd.concat(results)
-        # else:
-        #     results = self._fan_out(files, fields, select_criteria, table)
-        #
-        # self._remove_duplicates(results, table)
-        # self._sort(results)
-        #
-        # return results
+    def _cache_key(self, query: domain.ParsedQuery, table: domain.Table) -> str:
+        """
+        Results are cached against the files they were read from, so any write to a partition the query touches
+        invalidates the entry.
+        """
+        try:
+            criteria = query.get_criteria()
+            criteria = self._coerce_criteria(ff.BinaryOp.from_dict(criteria), table) if criteria is not None else None
+        except domain.UnsupportedQuery:
+            criteria = None
+
+        key = f'{query.get_normalized_sql()}|{self._dal.get_fingerprint(table, criteria)}'
+
+        return sha256(key.encode('utf-8')).hexdigest()
+
+    def _get_select_fields(self, query: domain.ParsedQuery) -> Optional[dict]:
+        select = query.get_select_fields()
+        if select == '*':
+            return None
+
+        ret = {}
+        for field in (select if isinstance(select, list) else [select]):
+            if not isinstance(field, dict) or not isinstance(field.get('value'), str):
+                raise domain.UnsupportedQuery(f'Unsupported select expression: {field}')
+            ret[field['value']] = field.get('name', field['value'])
+
+        return ret
+
+    def _coerce_criteria(self, criteria: ff.BinaryOp, table: domain.Table):
+        # Date literals arrive from the sql as strings, but must be compared to the column's own type.
+        for attr, value in (('lhv', 'rhv'), ('rhv', 'lhv')):
+            operand = getattr(criteria, attr)
+            if isinstance(operand, ff.BinaryOp):
+                setattr(criteria, attr, self._coerce_criteria(operand, table))
+            elif isinstance(operand, (ff.Attr, ff.AttributeString)):
+                try:
+                    data_type = table.get_column(str(operand)).data_type
+                except domain.ColumnNotFound:
+                    continue
+                if data_type in (date, datetime):
+                    setattr(criteria, value, self._coerce_value(getattr(criteria, value), data_type))
+
+        return criteria
+
+    def _coerce_value(self, value, data_type: type):
+        if isinstance(value, (list, tuple)):
+            return [self._coerce_value(v, data_type) for v in value]
+        if not isinstance(value, str):
+            return value
+        value = pd.Timestamp(value)
+
+        return value.date() if data_type is date else value.to_pydatetime()
+
+    def _criteria_attributes(self, criteria) -> list:
+        if not isinstance(criteria, ff.BinaryOp):
+            return []
+
+        ret = []
+        for operand in (criteria.lhv, criteria.rhv):
+            if isinstance(operand, ff.BinaryOp):
+                ret.extend(self._criteria_attributes(operand))
+            elif isinstance(operand, (ff.Attr, ff.AttributeString)):
+                ret.append(str(operand))
+
+        return ret
+
+    @staticmethod
+    def _has_column(table: domain.Table, name: str):
+        try:
+            table.get_column(name)
+            return True
+        except domain.ColumnNotFound:
+            return name == 'dt' and table.time_partitioning is not None
 
     def _fan_out(self, files: list, fields: list, select_criteria: ff.BinaryOp, table: domain.Table):
         output_path = f'tmp/ff-query-results/{str(uuid.uuid4())}'
@@ -103,8 +340,8 @@ class QueryWarehouse(ff.DomainService):
 
         return self._wait_for_results(output_files)
 
-    def _process_criteria(self, table: domain.Table):
-        criteria_dict = self._sql_parser.get_criteria()
+    def _process_criteria(self, query: domain.ParsedQuery, table: domain.Table):
+        criteria_dict = query.get_criteria()
         partition_criteria = None
         select_criteria = None
         if criteria_dict is not None:
@@ -112,7 +349,7 @@ class QueryWarehouse(ff.DomainService):
             partitions = list(map(lambda t: t.name, table.partitions))
             partition_criteria = criteria.prune(partitions)
             select_criteria = criteria.prune(
-                self._sql_parser.get_all_criteria_attributes(partitions, criteria)
+                query.get_all_criteria_attributes(partitions, criteria)
             )
         return partition_criteria, select_criteria
 
@@ -124,9 +361,11 @@ class QueryWarehouse(ff.DomainService):
 
         return self._dal.read_tmp_files(files)
 
-    def _sort(self, data: pd.DataFrame):
-        fields, ascending = self._sql_parser.get_sort_order()
-        if len(list(map(lambda x: x not in data, fields))) == 0:
+    def _sort(self, query: domain.ParsedQuery, data: pd.DataFrame):
+        if 'orderby' not in query.get_clauses():
+            return
+        fields, ascending = query.get_sort_order()
+        if all(map(lambda x: x in data, fields)):
             data.sort_values(by=fields, ascending=ascending, inplace=True)
 
 
@@ -1,15 +1,89 @@
 from __future__ import annotations
 
 import firefly as ff
+import numpy as np
 import pandas as pd
 
 import firefly_integration.domain as domain
 
 
 class RemoveDuplicates(ff.DomainService):
+    """
+    Keeps one row per duplicate_fields key, in place: the row with the highest duplicate_sort values. As with a
+    sort, missing sort values rank highest and ties go to the row that comes last. Rather than sorting the frame,
+    the winner of each key group is found with grouped max reductions. When the frame is already in duplicate_sort
+    order, a plain drop_duplicates does the job. Tables without duplicate_fields only lose rows that are exact
+    duplicates.
+    """
+
     def __call__(self, df: pd.DataFrame, table: domain.Table):
+        if df.empty:
+            return
+        if not table.duplicate_fields:
+            df.drop_duplicates(keep='last', inplace=True)
+            return
+
         try:
-            df.sort_values(table.duplicate_sort, inplace=True)
-            df.drop_duplicates(subset=table.duplicate_fields, keep='last', inplace=True)
-        except IndexError:
-            pass
+            if _is_presorted(df, table):
+                df.drop_duplicates(subset=table.duplicate_fields, keep='last', inplace=True)
+                return
+            keep = self.winners(df, table)
+        except (IndexError, KeyError):
+            return
+
+        if not keep.all():
+            df['$keep'] = keep
+            df.query('`$keep`', inplace=True)
+            del df['$keep']
+
+    @staticmethod
+    def winners(df: pd.DataFrame, table: domain.Table) -> np.ndarray:
+        """
+        Returns a boolean array that is True for the rows to keep.
+        """
+        # The sort columns are checked before any key is factorized, so presorted input costs no more than a plain
+        # duplicated().
+        if _is_presorted(df, table):
+            return ~df.duplicated(subset=table.duplicate_fields, keep='last').values
+
+        groups = _group_codes(df, table.duplicate_fields)
+        sort = table.duplicate_sort
+        candidates = np.arange(len(df))
+        for name in sort:
+            values = df[name].iloc[candidates].reset_index(drop=True)
+            codes = groups[candidates]
+            best = (values == values.groupby(codes, sort=False).transform('max')).values
+            missing = values.isna()
+            if missing.any():
+                best = np.where(missing.groupby(codes, sort=False).transform('any').values, missing.values, best)
+            candidates = candidates[best]
+
+        keep = np.zeros(len(df), dtype=bool)
+        keep[candidates[~pd.Series(groups[candidates]).duplicated(keep='last').values]] = True
+
+        return keep
+
+
+def _group_codes(df: pd.DataFrame, fields: list) -> np.ndarray:
+    # Factorizing each key column once is much cheaper than hashing whole rows, and later steps only see integers.
+    ret = None
+    for name in fields:
+        codes, uniques = pd.factorize(df[name], use_na_sentinel=False)
+        ret = codes if ret is None else pd.factorize(ret * (len(uniques) + 1) + codes)[0]
+
+    return ret
+
+
+def _is_presorted(df: pd.DataFrame, table: domain.Table) -> bool:
+    sort = table.duplicate_sort or []
+
+    return len(sort) == 0 or _is_sorted(df, sort)
+
+
+def _is_sorted(df: pd.DataFrame, sort: list) -> bool:
+    if df[sort].isna().values.any():
+        return False
+    if len(sort) == 1:
+        return df[sort[0]].is_monotonic_increasing
+
+    return pd.MultiIndex.from_frame(df[sort]).is_monotonic_increasing
@@ -2,23 +2,71 @@ from __future__ import annotations
 
 from datetime import datetime, date
 from typing import Union, List
+from weakref import WeakKeyDictionary
 
 import firefly as ff
+import pyarrow as pa
+import pyarrow.compute as pc
 
 import firefly_integration.domain as domain
 import pandas as pd
 import numpy as np
 
+DATETIME = 'datetime'
+INT = 'int'
+OTHER = 'other'
+
+
+class CoercionPlan:
+    """
+    Everything SanitizeInputData needs to know about a table, worked out once: what each column gets cast to,
+    which columns are allowed to stay, and the Arrow schema the columns are cast against. The schema is only built
+    the first time Arrow input comes along.
+    """
+
+    def __init__(self, table: domain.Table):
+        self.signature = self.signature_of(table)
+        self.columns = []
+        for column in table.columns:
+            if column.data_type in (date, datetime):
+                kind, dtype = DATETIME, np.dtype('datetime64[ns]')
+            elif column.data_type is int or column.data_type == 'int':
+                kind, dtype = INT, np.dtype('int64')
+            else:
+                kind, dtype = OTHER, pd.api.types.pandas_dtype(column.pandas_type)
+            self.columns.append((column, kind, dtype))
+        self.allowed = set(map(lambda c: c.name, table.columns)) | set(table.partitions)
+        self._schema = None
+
+    @property
+    def schema(self) -> pa.Schema:
+        # Built from the plan's own columns; holding on to the table would keep it alive in SanitizeInputData._plans.
+        if self._schema is None:
+            self._schema = pa.schema([pa.field(column.name, column.arrow_type) for column, _, _ in self.columns])
+        return self._schema
+
+    @staticmethod
+    def signature_of(table: domain.Table):
+        return tuple(map(lambda c: (c.name, c.data_type, id(c.default), c.required), table.columns)), \
+               tuple(table.partitions)
+
 
 class SanitizeInputData(ff.DomainService):
-    def __call__(self, data: Union[List[dict], dict, pd.DataFrame], table: domain.Table,
-                 validate: bool = True, add_missing_columns: bool = True) -> pd.DataFrame:
+    def __init__(self):
+        self._plans = WeakKeyDictionary()
+
+    def __call__(self, data: Union[List[dict], dict, pd.DataFrame, pa.Table], table: domain.Table,
+                 validate: bool = True, add_missing_columns: bool = True) -> Union[pd.DataFrame, pa.Table]:
+        plan = self.plan(table)
+        if isinstance(data, pa.Table):
+            return self._sanitize_arrow(data, plan, validate, add_missing_columns)
+
         if not isinstance(data, pd.DataFrame):
             df = pd.DataFrame(data if isinstance(data, list) else [data])
         else:
             df = data
 
-        for column in table.columns:
+        for column, kind, dtype in plan.columns:
             if column.name not in df:
                 if not add_missing_columns:
                     continue
@@ -28,30 +76,83 @@ class SanitizeInputData(ff.DomainService):
                     raise domain.InvalidInputData(column.name)
                 elif df.index.name != column.name:
                     df[column.name] = np.nan
-            if column.data_type in (date, datetime):
+            if kind == DATETIME:
+                if df[column.name].dtype == dtype:
+                    continue
                 if df[column.name].dtype == 'object':
                     try:
-                        df[column.name] = np.float64(df[column.name])
+                        df[column.name] = df[column.name].astype(np.float64)
                     except (ValueError, TypeError):
                         pass
                 df[column.name] = pd.to_datetime(df[column.name]).dt.tz_localize(None)
-            elif df.index.name != column.name:
-                if column.data_type is int or column.data_type == 'int':
+            elif df.index.name != column.name and df[column.name].dtype != dtype:
+                if kind == INT:
                     try:
                         df[column.name] = df[column.name].astype(np.float64).astype(np.int64)
                     except (ValueError, TypeError):
                         df[column.name] = np.nan
                 else:
-                    df[column.name] = df[column.name].astype(column.pandas_type)
+                    df[column.name] = df[column.name].astype(dtype)
 
-        columns = list(map(lambda cc: cc.name, table.columns))
-        for c in df.columns:
-            if c not in columns and c not in table.partitions:
-                try:
-                    del df[c]
-                except KeyError:
-                    pass
+        extra = [c for c in df.columns if c not in plan.allowed]
+        if len(extra) > 0:
+            df.drop(columns=extra, inplace=True)
 
-        df.replace([np.inf, -np.inf], value=np.nan, inplace=True)
+        for name in df.columns:
+            values = df[name].values
+            if values.dtype.kind == 'f' and np.isinf(values).any():
+                df[name] = df[name].replace([np.inf, -np.inf], value=np.nan)
 
         return df
+
+    def plan(self, table: domain.Table) -> CoercionPlan:
+        plan = self._plans.get(table)
+        if plan is None or plan.signature != CoercionPlan.signature_of(table):
+            plan = CoercionPlan(table)
+            self._plans[table] = plan
+
+        return plan
+
+    def _sanitize_arrow(self, data: pa.Table, plan: CoercionPlan, validate: bool,
+                        add_missing_columns: bool) -> pa.Table:
+        names = []
+        arrays = []
+        for (column, kind, _), field in zip(plan.columns, plan.schema):
+            if column.name in data.column_names:
+                array = self._cast(data.column(column.name), field.type, column)
+            elif not add_missing_columns:
+                continue
+            elif column.default is not domain.NoDefault:
+                array = self._cast(pa.array([column.default] * data.num_rows), field.type, column)
+            elif column.required and validate is True:
+                raise domain.InvalidInputData(column.name)
+            else:
+                array = pa.nulls(data.num_rows, field.type)
+            if pa.types.is_floating(array.type):
+                array = pc.if_else(pc.is_inf(array), pa.scalar(None, array.type), array)
+            names.append(column.name)
+            arrays.append(array)
+
+        for name in data.column_names:
+            if name in plan.allowed and name not in names:
+                names.append(name)
+                arrays.append(data.column(name))
+
+        return pa.table(arrays, names=names)
+
+    def _cast(self, array: Union[pa.Array, pa.ChunkedArray], target: pa.DataType, column: domain.Column):
+        if array.type == target:
+            return array
+
+        if not pa.types.is_timestamp(array.type) or array.type.tz is None:
+            try:
+                return array.cast(target, safe=False)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+                pass
+
+        # Anything Arrow can't cast directly (strings / epochs to timestamps, tz-aware timestamps) goes through the
+        # same coercion as a DataFrame would, so both paths agree.
+        df = pd.DataFrame({column.name: array.to_pandas()})
+        df = self(df, column.table, validate=False, add_missing_columns=False)
+
+        return pa.array(df[column.name], from_pandas=True).cast(target, safe=False)
@@ -1,31 +1,49 @@
 from __future__ import annotations
 
+from copy import deepcopy
+from functools import lru_cache
 from typing import Tuple, List
 
 import firefly as ff
-from moz_sql_parser import parse
+from moz_sql_parser import parse, format as format_sql
 
 import firefly_integration.domain as domain
 
+PARSE_CACHE_SIZE = 1024
 OPS = {
-    'eq': '==', 'ne': '!=', 'lt': '<', 'gt': '>', 'lte': '<=', 'gte': '>=', 'is': 'is'
+    'eq': '==', 'ne': '!=', 'neq': '!=', 'lt': '<', 'gt': '>', 'lte': '<=', 'gte': '>=', 'is': 'is'
 }
 
 
-class SqlParser(ff.DomainService):
+class ParsedQuery:
+    """
+    The result of SqlParser.parse(). Holds no reference to the parser, so it can be used freely across threads.
+    """
+    sql: str = None
     _parts: dict = None
     _non_partition_keys: list = None
 
-    def parse(self, sql: str):
-        self._parts = parse(sql)
+    def __init__(self, sql: str, parts: dict):
+        self.sql = sql
+        self._parts = parts
         self._non_partition_keys = []
 
+    def get_normalized_sql(self) -> str:
+        return _normalize(self.sql)
+
+    def get_clauses(self) -> List[str]:
+        return list(self._parts.keys())
+
+    def get_limit(self):
+        return self._parts.get('limit')
+
     def get_select_fields(self):
-        self._ensure_parse_called()
         return self._parts['select']
 
+    def get_from(self):
+        return self._parts.get('from')
+
     def get_table(self):
-        self._ensure_parse_called()
         if isinstance(self._parts['from'], str):
             return self._parts['from']
         for table in self._parts['from']:
@@ -33,7 +51,6 @@ class SqlParser(ff.DomainService):
                 return table['value']
 
     def get_sort_order(self) -> Tuple[List[str], List[bool]]:
-        self._ensure_parse_called()
         fields = []
         ascending = []
         if 'orderby' in self._parts:
@@ -53,7 +70,6 @@ class SqlParser(ff.DomainService):
         return fields, ascending
 
     def get_criteria(self, data=None, criteria: dict = None):
-        self._ensure_parse_called()
 
         if data is None:
             if 'where' not in self._parts:
@@ -91,13 +107,37 @@ class SqlParser(ff.DomainService):
                                 'r': self.get_criteria(value[i], criteria)
                             }
 
-                elif op in ('eq', 'ne', 'lt', 'gt', 'lte', 'gte', 'is'):
+                elif op in OPS:
                     return {
                         'l': self.get_criteria(value[0], criteria),
                         'o': OPS[op],
                         'r': self.get_criteria(value[1], criteria)
                     }
 
+                elif op in ('in', 'nin'):
+                    values = value[1]['literal'] if isinstance(value[1], dict) else value[1]
+                    return {
+                        'l': self.get_criteria(value[0], criteria),
+                        'o': 'in' if op == 'in' else 'not in',
+                        'r': values if isinstance(values, list) else [values],
+                    }
+
+                elif op == 'between':
+                    return {
+                        'l': {'l': self.get_criteria(value[0]), 'o': '>=', 'r': self.get_criteria(value[1])},
+                        'o': 'and',
+                        'r': {'l': self.get_criteria(value[0]), 'o': '<=', 'r': self.get_criteria(value[2])},
+                    }
+
+                elif op in ('missing', 'exists'):
+                    return {'l': self.get_criteria(value), 'o': 'is' if op == 'missing' else 'is not', 'r': None}
+
+                elif op == 'like':
+                    return self._like(self.get_criteria(value[0]), self.get_criteria(value[1]))
+
+                else:
+                    raise domain.UnsupportedQuery(f'Unsupported operator in where clause: {op}')
+
         return criteria
 
     def get_all_criteria_attributes(self, partitions: list, criteria: ff.BinaryOp):
@@ -113,6 +153,68 @@ class SqlParser(ff.DomainService):
 
         return ret
 
-    def _ensure_parse_called(self):
-        if self._parts is None:
+    @staticmethod
+    def _like(attr, pattern: str):
+        body = pattern.strip('%')
+        if '%' in body or '_' in body:
+            raise domain.UnsupportedQuery(f'Unsupported like pattern: {pattern}')
+        if pattern.startswith('%') and pattern.endswith('%'):
+            op = 'contains'
+        elif pattern.endswith('%'):
+            op = 'startswith'
+        elif pattern.startswith('%'):
+            op = 'endswith'
+        else:
+            op = '=='
+
+        return {'l': attr, 'o': op, 'r': body}
+
+
+class SqlParser(ff.DomainService):
+    _query: ParsedQuery = None
+
+    def parse(self, sql: str) -> ParsedQuery:
+        self._query = ParsedQuery(sql, deepcopy(_parse(sql)))
+        return self._query
+
+    # The accessors below operate on the most recent parse() and are kept for backwards compatibility. They aren't
+    # safe to use from multiple threads; use the ParsedQuery returned by parse() instead.
+
+    def get_normalized_sql(self) -> str:
+        return self._ensure_parse_called().get_normalized_sql()
+
+    def get_clauses(self) -> List[str]:
+        return self._ensure_parse_called().get_clauses()
+
+    def get_limit(self):
+        return self._ensure_parse_called().get_limit()
+
+    def get_select_fields(self):
+        return self._ensure_parse_called().get_select_fields()
+
+    def get_table(self):
+        return self._ensure_parse_called().get_table()
+
+    def get_sort_order(self) -> Tuple[List[str], List[bool]]:
+        return self._ensure_parse_called().get_sort_order()
+
+    def get_criteria(self, data=None, criteria: dict = None):
+        return self._ensure_parse_called().get_criteria(data, criteria)
+
+    def get_all_criteria_attributes(self, partitions: list, criteria: ff.BinaryOp):
+        return self._ensure_parse_called().get_all_criteria_attributes(partitions, criteria)
+
+    def _ensure_parse_called(self) -> ParsedQuery:
+        if self._query is None:
             raise domain.IntegrationError('You must call parse() before get_criteria()')
+        return self._query
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(sql: str) -> dict:
+    return parse(sql)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _normalize(sql: str) -> str:
+    return format_sql(_parse(sql))
@@ -13,7 +13,44 @@ import numpy as np
 class StoreData(ff.DomainService):
     _sanitize_input_data: domain.SanitizeInputData = None
     _dal: domain.Dal = None
+    _write_buffer: domain.WriteBuffer = None
+    _buffer_writes: str = None
 
-    def __call__(self, data, table: domain.Table):
+    def __call__(self, data, table: domain.Table, buffered: bool = None):
         df = self._sanitize_input_data(data, table)
-        self._dal.store(df, table)
+        if buffered is None:
+            buffered = self._buffer_writes == 'true'
+        if buffered:
+            self._write_buffer.add(df, table)
+        else:
+            self._dal.store(df, table)
+
+    def store_many(self, data: dict, buffered: bool = None) -> dict:
+        """
+        Takes a dict of table to data and stores every table concurrently. Returns the failures keyed by table name;
+        an empty dict means everything was written.
+        """
+        failures = {}
+        sanitized = {}
+        for table, rows in data.items():
+            try:
+                sanitized[table] = self._sanitize_input_data(rows, table)
+            except Exception as e:
+                failures[table.name] = e
+
+        if buffered is None:
+            buffered = self._buffer_writes == 'true'
+        if not buffered:
+            failures.update(self._dal.store_many(sanitized))
+            return failures
+
+        for table, df in sanitized.items():
+            try:
+                self._write_buffer.add(df, table)
+            except Exception as e:
+                failures[table.name] = e
+
+        return failures
+
+    def flush(self, table: domain.Table = None):
+        self._write_buffer.flush(table)
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import atexit
+from threading import Condition, Thread
+from time import time
+from typing import Union, List, Dict, Tuple, Optional
+
+import firefly as ff
+import pandas as pd
+import pyarrow as pa
+
+import firefly_integration.domain as domain
+
+
+class _Buffer:
+    def __init__(self, key: Tuple[str, tuple], table: domain.Table):
+        self.key = key
+        self.table = table
+        self.frames = []
+        self.rows = 0
+        self.bytes = 0
+        self.created_on = time()
+
+    def append(self, data: Union[pd.DataFrame, pa.Table], size: int):
+        self.frames.append(data)
+        self.rows += len(data)
+        self.bytes += size
+
+
+class WriteBuffer(ff.DomainService, ff.LoggerAware):
+    """
+    Gathers sanitized rows per table and partition and hands them to Dal.store in one piece, so a stream of small
+    writes becomes a few reasonably sized files. A partition is flushed when it reaches _write_buffer_rows rows,
+    _write_buffer_bytes bytes or _write_buffer_age seconds. Once everything buffered goes over _write_buffer_limit
+    bytes, the writer that pushed it over flushes the largest partitions itself before returning.
+
+    Rows are only durable after a flush. Everything left is flushed when the interpreter exits; call flush() before
+    anything that has to see the rows (or before a Lambda invocation returns). If a flush triggered by add() fails,
+    the rows stay buffered for the next flush and the error is logged, as long as the buffer is under
+    _write_buffer_limit. Past the limit add() raises instead, and takes the caller's rows back out first so a retry
+    doesn't buffer them twice. flush() always raises.
+    """
+    _dal: domain.Dal = None
+    _write_buffer_rows: str = None
+    _write_buffer_bytes: str = None
+    _write_buffer_age: str = None
+    _write_buffer_limit: str = None
+
+    def __init__(self):
+        if self._write_buffer_rows is None:
+            self._write_buffer_rows = '500000'
+        if self._write_buffer_bytes is None:
+            self._write_buffer_bytes = str(64 * 1024 ** 2)
+        if self._write_buffer_age is None:
+            self._write_buffer_age = '60'
+        if self._write_buffer_limit is None:
+            self._write_buffer_limit = str(512 * 1024 ** 2)
+        self._buffers: Dict[Tuple[str, tuple], _Buffer] = {}
+        self._buffered_bytes = 0
+        self._condition = Condition()
+        self._flusher: Optional[Thread] = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def add(self, data: Union[pd.DataFrame, pa.Table], table: domain.Table):
+        if len(data) == 0:
+            return
+
+        full = []
+        added = []
+        with self._condition:
+            for partition, rows in self._split(data, table):
+                size = _size_of(rows)
+                key = (table.name, partition)
+                if key not in self._buffers:
+                    self._buffers[key] = _Buffer(key, table)
+                buffer = self._buffers[key]
+                buffer.append(rows, size)
+                added.append((key, rows, size))
+                self._buffered_bytes += size
+                if buffer.rows >= int(self._write_buffer_rows) or buffer.bytes >= int(self._write_buffer_bytes):
+                    full.append(key)
+            full.extend(self._expired())
+            full.extend(self._over_limit(set(full)))
+            buffers = self._take(full)
+            self._start_flusher()
+
+        self._store(buffers, added)
+
+    def flush(self, table: domain.Table = None):
+        """
+        Synchronously stores everything buffered, or only the rows for the given table.
+        """
+        with self._condition:
+            buffers = self._take([k for k in self._buffers.keys() if table is None or k[0] == table.name])
+        self._store(buffers)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.flush()
+
+    @property
+    def buffered_rows(self) -> int:
+        with self._condition:
+            return sum(b.rows for b in self._buffers.values())
+
+    def _split(self, data: Union[pd.DataFrame, pa.Table], table: domain.Table):
+        keys = self._partition_keys(data, table)
+        if keys is None:
+            yield (), data
+            return
+
+        groups = keys.groupby(list(keys.columns), sort=False, observed=True, dropna=False).indices
+        if len(groups) == 1:
+            yield self._key(next(iter(groups.keys()))), data
+            return
+
+        for values, rows in groups.items():
+            if isinstance(data, pa.Table):
+                yield self._key(values), data.take(pa.array(rows))
+            else:
+                yield self._key(values), data.iloc[rows]
+
+    @staticmethod
+    def _partition_keys(data: Union[pd.DataFrame, pa.Table], table: domain.Table) -> Optional[pd.DataFrame]:
+        if len(table.partition_names) == 0:
+            return None
+
+        return table.partition_values(data)
+
+    @staticmethod
+    def _key(values) -> tuple:
+        values = values if isinstance(values, tuple) else (values,)
+        return tuple(None if pd.isna(v) else v for v in values)
+
+    def _expired(self) -> List[Tuple[str, tuple]]:
+        cutoff = time() - float(self._write_buffer_age)
+        return [k for k, b in self._buffers.items() if b.created_on <= cutoff]
+
+    def _over_limit(self, flushing: set) -> List[Tuple[str, tuple]]:
+        ret = []
+        remaining = self._buffered_bytes - sum(self._buffers[k].bytes for k in flushing)
+        largest = sorted((k for k in self._buffers.keys() if k not in flushing), key=lambda k: -self._buffers[k].bytes)
+        for key in largest:
+            if remaining <= int(self._write_buffer_limit):
+                break
+            ret.append(key)
+            remaining -= self._buffers[key].bytes
+
+        return ret
+
+    def _take(self, keys: List[Tuple[str, tuple]]) -> List[_Buffer]:
+        ret = []
+        for key in dict.fromkeys(keys):
+            buffer = self._buffers.pop(key, None)
+            if buffer is not None:
+                self._buffered_bytes -= buffer.bytes
+                ret.append(buffer)
+
+        return ret
+
+    def _restore(self, buffer: _Buffer):
+        # A failed flush puts its rows back in front of anything buffered since, so nothing is lost or reordered.
+        with self._condition:
+            newer = self._buffers.get(buffer.key)
+            if newer is not None:
+                buffer.frames.extend(newer.frames)
+                buffer.rows += newer.rows
+                buffer.bytes += newer.bytes
+                self._buffered_bytes -= newer.bytes
+            self._buffers[buffer.key] = buffer
+            self._buffered_bytes += buffer.bytes
+
+    def _discard(self, added: List[tuple]):
+        for key, rows, size in added:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                continue
+            for i, frame in enumerate(buffer.frames):
+                if frame is rows:
+                    del buffer.frames[i]
+                    buffer.rows -= len(rows)
+                    buffer.bytes -= size
+                    self._buffered_bytes -= size
+                    break
+            if len(buffer.frames) == 0:
+                del self._buffers[key]
+
+    def _store(self, buffers: List[_Buffer], added: List[tuple] = None):
+        # Buffers for the same table are stored together; the DAL splits them back into partitions. `added` holds the
+        # rows add() just buffered (see the class docstring for how a failure is handled then).
+        by_table: Dict[str, List[_Buffer]] = {}
+        for buffer in buffers:
+            by_table.setdefault(buffer.table.name, []).append(buffer)
+
+        groups = list(by_table.values())
+        for i, group in enumerate(groups):
+            try:
+                self._dal.store(_concat([f for b in group for f in b.frames]), group[0].table)
+            except Exception as e:
+                with self._condition:
+                    for buffer in (b for g in groups[i:] for b in g):
+                        self._restore(buffer)
+                    over_limit = self._buffered_bytes > int(self._write_buffer_limit)
+                    if added is not None and over_limit:
+                        self._discard(added)
+                if added is None or over_limit:
+                    raise
+                self.error(f'Could not flush write buffer: {str(e)}')
+                return
+
+    def _start_flusher(self):
+        if self._flusher is not None or self._closed:
+            return
+        self._flusher = Thread(target=self._flush_expired, name='write-buffer-flusher', daemon=True)
+        self._flusher.start()
+
+    def _flush_expired(self):
+        interval = max(float(self._write_buffer_age) / 4, 0.1)
+        while True:
+            with self._condition:
+                self._condition.wait(interval)
+                if self._closed:
+                    return
+                buffers = self._take(self._expired())
+            try:
+                self._store(buffers)
+            except Exception as e:
+                self.error(f'Could not flush write buffer: {str(e)}')
+
+
+def _size_of(data: Union[pd.DataFrame, pa.Table]) -> int:
+    if isinstance(data, pa.Table):
+        return data.nbytes
+    return int(data.memory_usage(index=False, deep=False).sum())
+
+
+def _concat(frames: list) -> Union[pd.DataFrame, pa.Table]:
+    if len(frames) == 1:
+        return frames[0]
+    if all(isinstance(f, pa.Table) for f in frames):
+        return pa.concat_tables(frames, promote_options='default')
+
+    return pd.concat(
+        [f.to_pandas() if isinstance(f, pa.Table) else f for f in frames], ignore_index=True, copy=False
+    )
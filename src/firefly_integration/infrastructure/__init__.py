@@ -8,8 +8,8 @@ from .service import *
 orig = parquet.ParquetWriter.__init__
 
 
-def init(self, use_deprecated_int96_timestamps=False, allow_truncated_timestamps=True, **kwargs):
-    orig(self, use_deprecated_int96_timestamps=use_deprecated_int96_timestamps,
+def init(self, *args, use_deprecated_int96_timestamps=False, allow_truncated_timestamps=True, **kwargs):
+    orig(self, *args, use_deprecated_int96_timestamps=use_deprecated_int96_timestamps,
          allow_truncated_timestamps=allow_truncated_timestamps, **kwargs)
 
 
@@ -10,6 +10,7 @@ from troposphere import Template
 from troposphere.glue import Database, DatabaseInput, Table, TableInput, Column, StorageDescriptor, SerdeInfo
 
 import firefly_integration.domain as ffi
+from firefly_integration.infrastructure.service.dal.partition_projection import projection_parameters
 
 
 @ff.agent.pre_deploy_hook(for_='aws')
@@ -48,13 +49,8 @@ class AddGlueDataCatalog(ff.AgentExtension):
             TableInput=TableInput(
                 Description=table.description or '',
                 Name=table.name,
-                Parameters={
-                    'projection.enabled': False,
-                },
-                PartitionKeys=[
-                    Column(Comment=part.comment or '', Name=part.name, Type=self._athena_type(part.data_type))
-                    for part in table.partitions
-                ],
+                Parameters=projection_parameters(table, path),
+                PartitionKeys=self._partition_keys(table),
                 StorageDescriptor=StorageDescriptor(
                     InputFormat='org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
                     OutputFormat='org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat',
@@ -63,14 +59,27 @@ class AddGlueDataCatalog(ff.AgentExtension):
                     ),
                     Location=path,
                     Columns=[
-                        Column(Comment=c.comment or '', Name=c.name, Type=self._athena_type(c.data_type))
-                        for c in table.columns
+                        Column(Comment=c.description or '', Name=c.name, Type=self._athena_type(c.data_type))
+                        for c in table.columns if c.name not in table.partition_names
                     ]
                 )
             ),
             DependsOn=[db]
         ))
 
+    def _partition_keys(self, table: ffi.Table):
+        ret = []
+        for name in table.partition_names:
+            if table.has_column(name) and name != 'dt':
+                column = table.get_column(name)
+                ret.append(Column(
+                    Comment=column.description or '', Name=name, Type=self._athena_type(column.data_type)
+                ))
+            else:
+                ret.append(Column(Comment='', Name=name, Type='string'))
+
+        return ret
+
     def _athena_type(self, t: type):
         if t is str:
             return 'string'
@@ -2,3 +2,4 @@ import importlib.util
 
 if importlib.util.find_spec('firefly_aws') is not None:
     from .aws_dal import AwsDal
+from .local_dal import LocalDal
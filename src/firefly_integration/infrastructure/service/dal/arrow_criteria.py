@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+from datetime import datetime, date
+from typing import Optional
+
+import firefly as ff
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+import firefly_integration.domain as domain
+
+UNKNOWN = None
+
+
+def partition_fields(table: domain.Table) -> list:
+    return table.partition_names
+
+
+def partitioning(table: domain.Table) -> ds.Partitioning:
+    return ds.partitioning(pa.schema(_partition_schema_fields(table)), flavor='hive')
+
+
+def file_schema(table: domain.Table) -> pa.Schema:
+    fields = partition_fields(table)
+
+    return pa.schema([f for f in table.arrow_schema if f.name not in fields])
+
+
+def dataset_schema(table: domain.Table) -> pa.Schema:
+    return pa.schema(list(file_schema(table)) + _partition_schema_fields(table))
+
+
+def partition_values(path: str) -> dict:
+    ret = {}
+    for part in path.rstrip('/').split('/'):
+        if '=' in part:
+            k, v = part.split('=', 1)
+            ret[k] = None if v == '__HIVE_DEFAULT_PARTITION__' else v
+
+    return ret
+
+
+def partition_matches(criteria: Optional[ff.BinaryOp], values: dict, table: domain.Table = None) -> bool:
+    """
+    Evaluates criteria against the key/value pairs of a hive partition path. Anything that can't be decided from the
+    partition values alone (non-partition attributes, type mismatches) is treated as a possible match, so a partition
+    is only pruned when it definitely can't contain matching rows.
+    """
+    if criteria is None:
+        return True
+
+    if table is not None:
+        values = _cast_partition_values(values, table)
+
+    return _evaluate(criteria, values) is not False
+
+
+def glue_expression(criteria: Optional[ff.BinaryOp], table: domain.Table) -> Optional[str]:
+    """
+    Translates the parts of the criteria that only involve partition columns into a Glue partition expression, so Glue
+    filters the partitions server side. Parts that can't be translated are dropped from an AND, which only widens the
+    result; callers still check partition_matches. Returns None when nothing can be pushed down.
+    """
+    if criteria is None:
+        return None
+
+    return _glue_expression(criteria, set(partition_fields(table)), table)
+
+
+def to_expression(criteria: Optional[ff.BinaryOp]) -> Optional[ds.Expression]:
+    if criteria is None:
+        return None
+
+    return _to_expression(criteria)
+
+
+def criteria_fields(criteria: Optional[ff.BinaryOp]) -> list:
+    if criteria is None:
+        return []
+
+    ret = []
+    for value in (criteria.lhv, criteria.rhv):
+        if isinstance(value, ff.BinaryOp):
+            ret.extend(f for f in criteria_fields(value) if f not in ret)
+        elif _is_attr(value) and str(value) not in ret:
+            ret.append(str(value))
+
+    return ret
+
+
+def matching_rows(fragment: ds.ParquetFileFragment, schema: pa.Schema, criteria: ff.BinaryOp) -> np.ndarray:
+    """
+    Returns the positions of the rows in a parquet file that match the criteria. Positions line up with a plain
+    read of the file, so the result can be used to mask the file's own columns without the partition columns.
+    """
+    fields = criteria_fields(criteria)
+    partition = partition_values(fragment.path)
+    data = fragment.to_table(schema=schema, columns=[f for f in fields if f not in partition])
+    for name in filter(lambda f: f in partition, fields):
+        data = data.append_column(
+            schema.field(name), pa.array([partition[name]] * data.num_rows, pa.string()).cast(schema.field(name).type)
+        )
+    data = data.append_column('$row', pa.array(np.arange(data.num_rows, dtype=np.int64)))
+    matched = ds.dataset(data).to_table(columns=['$row'], filter=to_expression(criteria))
+
+    return matched.column('$row').to_numpy()
+
+
+def _to_expression(criteria: ff.BinaryOp):
+    if criteria.op in ('and', 'or'):
+        lhv = _operand_expression(criteria.lhv)
+        rhv = _operand_expression(criteria.rhv)
+        return (lhv & rhv) if criteria.op == 'and' else (lhv | rhv)
+
+    lhv, rhv, op = criteria.lhv, criteria.rhv, criteria.op
+    if not _is_attr(lhv) and _is_attr(rhv):
+        lhv, rhv, op = rhv, lhv, _flip(op)
+
+    if not _is_attr(lhv):
+        return ds.scalar(bool(_compare(lhv, op, rhv)))
+
+    field = ds.field(str(lhv))
+    if op == '==':
+        return field == rhv
+    if op == '!=':
+        return field != rhv
+    if op == '>':
+        return field > rhv
+    if op == '<':
+        return field < rhv
+    if op == '>=':
+        return field >= rhv
+    if op == '<=':
+        return field <= rhv
+    if op == 'is':
+        if rhv is None or rhv == 'null':
+            return field.is_null()
+        return field == rhv
+    if op == 'is not':
+        if rhv is None or rhv == 'null':
+            return field.is_valid()
+        return field != rhv
+    if op == 'in':
+        return field.isin(list(rhv))
+    if op == 'not in':
+        return ~field.isin(list(rhv))
+    if op == 'startswith':
+        return pc.starts_with(field, pattern=rhv)
+    if op == 'endswith':
+        return pc.ends_with(field, pattern=rhv)
+    if op == 'contains':
+        return pc.match_substring(field, pattern=rhv)
+
+    raise domain.IntegrationError(f"Don't know how to handle op: {op}")
+
+
+def _operand_expression(value):
+    if isinstance(value, ff.BinaryOp):
+        return _to_expression(value)
+
+    return ds.scalar(bool(value))
+
+
+def _evaluate(criteria: ff.BinaryOp, values: dict):
+    if criteria.op in ('and', 'or'):
+        lhv = _evaluate(criteria.lhv, values) if isinstance(criteria.lhv, ff.BinaryOp) else bool(criteria.lhv)
+        rhv = _evaluate(criteria.rhv, values) if isinstance(criteria.rhv, ff.BinaryOp) else bool(criteria.rhv)
+        if criteria.op == 'and':
+            if lhv is False or rhv is False:
+                return False
+            return True if lhv is True and rhv is True else UNKNOWN
+        if lhv is True or rhv is True:
+            return True
+        return False if lhv is False and rhv is False else UNKNOWN
+
+    lhv = _resolve(criteria.lhv, values)
+    rhv = _resolve(criteria.rhv, values)
+    if lhv is UNKNOWN or rhv is UNKNOWN:
+        return UNKNOWN
+
+    try:
+        return bool(_compare(lhv[0], criteria.op, rhv[0]))
+    except (TypeError, ValueError):
+        return UNKNOWN
+
+
+def _resolve(value, values: dict):
+    if _is_attr(value):
+        if str(value) not in values:
+            return UNKNOWN
+        return values[str(value)],
+
+    if isinstance(value, (datetime, date)):
+        return str(value),
+
+    return value,
+
+
+def _compare(lhv, op: str, rhv):
+    if op == '==':
+        return lhv == rhv
+    if op == '!=':
+        return lhv != rhv
+    if op == '>':
+        return lhv > rhv
+    if op == '<':
+        return lhv < rhv
+    if op == '>=':
+        return lhv >= rhv
+    if op == '<=':
+        return lhv <= rhv
+    if op == 'is':
+        return lhv is None if rhv is None or rhv == 'null' else lhv == rhv
+    if op == 'is not':
+        return lhv is not None if rhv is None or rhv == 'null' else lhv != rhv
+    if op == 'in':
+        return lhv in rhv
+    if op == 'not in':
+        return lhv not in rhv
+    if op == 'startswith':
+        return str(lhv).startswith(rhv)
+    if op == 'endswith':
+        return str(lhv).endswith(rhv)
+    if op == 'contains':
+        return rhv in lhv
+
+    raise ValueError(op)
+
+
+def _partition_schema_fields(table: domain.Table) -> list:
+    ret = []
+    for name in table.partitions:
+        try:
+            ret.append(pa.field(name, table.get_column(name).arrow_type or pa.string()))
+        except domain.ColumnNotFound:
+            ret.append(pa.field(name, pa.string()))
+    if table.time_partitioning is not None:
+        ret.append(pa.field('dt', pa.string()))
+
+    return ret
+
+
+def _glue_expression(criteria: ff.BinaryOp, fields: set, table: domain.Table) -> Optional[str]:
+    if criteria.op in ('and', 'or'):
+        lhv = _glue_expression(criteria.lhv, fields, table) if isinstance(criteria.lhv, ff.BinaryOp) else None
+        rhv = _glue_expression(criteria.rhv, fields, table) if isinstance(criteria.rhv, ff.BinaryOp) else None
+        if lhv is not None and rhv is not None:
+            return f'({lhv}) {criteria.op.upper()} ({rhv})'
+        return (lhv or rhv) if criteria.op == 'and' else None
+
+    if _is_attr(criteria.lhv):
+        name, op, value = str(criteria.lhv), criteria.op, criteria.rhv
+    elif _is_attr(criteria.rhv):
+        name, op, value = str(criteria.rhv), _flip(criteria.op), criteria.lhv
+    else:
+        return None
+    if name not in fields:
+        return None
+
+    if op in ('in', 'not in') and isinstance(value, (list, tuple)) and len(value) > 0:
+        literals = [_glue_literal(v, name, table) for v in value]
+        if any(map(lambda l: l is None, literals)):
+            return None
+        return f'{name} {op.upper()} ({", ".join(literals)})'
+
+    glue_op = {'==': '=', '!=': '<>', '<': '<', '>': '>', '<=': '<=', '>=': '>='}.get(op)
+    literal = _glue_literal(value, name, table)
+    if glue_op is None or literal is None:
+        return None
+
+    return f'{name} {glue_op} {literal}'
+
+
+def _glue_literal(value, name: str, table: domain.Table) -> Optional[str]:
+    if isinstance(value, bool) or value is None:
+        return None
+    if table.type_dict.get(name, 'string') == 'string':
+        if not isinstance(value, (str, int, float)):
+            return None
+        return "'{}'".format(str(value).replace("'", "''"))
+    if isinstance(value, (int, float)):
+        return str(value)
+
+    return None
+
+
+def _flip(op: str):
+    return {'>': '<', '<': '>', '>=': '<=', '<=': '>='}.get(op, op)
+
+
+def _is_attr(value):
+    return isinstance(value, (ff.Attr, ff.AttributeString))
+
+
+def _cast_partition_values(values: dict, table: domain.Table):
+    ret = {}
+    for k, v in values.items():
+        ret[k] = v
+        if k == 'dt' or v is None or v == '':
+            continue
+        try:
+            t = table.get_column(k).data_type
+        except domain.ColumnNotFound:
+            continue
+        try:
+            if t is int:
+                ret[k] = int(v)
+            elif t is float:
+                ret[k] = float(v)
+            elif t is bool:
+                ret[k] = v.lower() == 'true'
+        except ValueError:
+            pass
+
+    return ret
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Iterator, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import firefly_integration.domain as domain
+from firefly_integration.domain.data_catalog.table import TIME_UNITS
+from .arrow_criteria import file_schema, partition_fields
+
+HIVE_DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# The same timestamp handling awswrangler uses for DataFrames: millisecond timestamps that Athena and Spark can read,
+# instead of Arrow's nanoseconds. The spark flavor would otherwise switch to INT96 timestamps.
+PARQUET_OPTIONS = {
+    'compression': 'snappy', 'coerce_timestamps': 'ms', 'allow_truncated_timestamps': True, 'flavor': 'spark',
+    'use_deprecated_int96_timestamps': False,
+}
+
+
+def prepare_for_store(data: pa.Table, table: domain.Table) -> pa.Table:
+    """
+    The Arrow equivalent of the column selection and audit / dt columns the DALs add to a DataFrame before storing it.
+    Columns are selected without copying, and the new values are computed with Arrow kernels.
+    """
+    names = list(map(lambda c: c.name, table.columns))
+    names.extend(p for p in table.partitions if p not in names)
+    data = data.select([n for n in names if n in data.column_names])
+    now = datetime.utcnow()
+
+    if 'created_on' in data.column_names:
+        column = data.column('created_on')
+        data = _replace(data, 'created_on', column.fill_null(pa.scalar(now, column.type)))
+    if 'updated_on' in data.column_names:
+        t = data.schema.field('updated_on').type
+        data = _replace(data, 'updated_on', pa.nulls(data.num_rows, t).fill_null(pa.scalar(now, t)))
+
+    if table.time_partitioning is not None:
+        column = data.column(table.time_partitioning_column)
+        if not pa.types.is_timestamp(column.type):
+            column = column.cast(pa.timestamp('ns'))
+        data = data.append_column('dt', _time_partition_values(column, table))
+
+    return data
+
+
+def split_partitions(data: pa.Table, table: domain.Table) -> Iterator[Tuple[str, pa.Table]]:
+    """
+    Yields the hive partition path (relative to the table) and the rows that belong in it, with the partition columns
+    dropped. Partition values are dictionary encoded and the rows are put in partition order with one stable argsort
+    over the combined codes, so each partition is a zero-copy slice.
+    """
+    schema = file_schema(table)
+    fields = partition_fields(table)
+    if len(fields) == 0:
+        yield '', data.select(schema.names).cast(schema)
+        return
+
+    codes = np.zeros(data.num_rows, dtype=np.int64)
+    dictionaries = []
+    for name in fields:
+        encoded = pc.dictionary_encode(data.column(name).combine_chunks(), null_encoding='encode')
+        codes = codes * len(encoded.dictionary) + encoded.indices.to_numpy(zero_copy_only=False)
+        dictionaries.append((encoded.dictionary.to_pylist(), encoded.indices.to_numpy(zero_copy_only=False)))
+
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.concatenate([[0], np.flatnonzero(np.diff(codes[order])) + 1, [len(order)]])
+    data = data.select(schema.names).cast(schema).take(pa.array(order))
+
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        row = order[start]
+        yield '/'.join(
+            f'{name}={_partition_value(values[indices[row]])}' for name, (values, indices) in zip(fields, dictionaries)
+        ), data.slice(start, end - start)
+
+
+def _time_partition_values(column: pa.ChunkedArray, table: domain.Table) -> pa.DictionaryArray:
+    # Floor to the period, then format each distinct period once rather than every row.
+    unit = table.time_partitioning if table.time_partitioning in TIME_UNITS else 'year'
+    periods = pc.floor_temporal(column, unit=unit)
+    encoded = pc.dictionary_encode(periods.combine_chunks(), null_encoding='encode')
+
+    return pa.DictionaryArray.from_arrays(
+        encoded.indices, pc.strftime(encoded.dictionary, format=table.time_partition_format)
+    )
+
+
+def _partition_value(value):
+    return HIVE_DEFAULT_PARTITION if value is None else value
+
+
+def _replace(data: pa.Table, name: str, column) -> pa.Table:
+    return data.set_column(data.schema.get_field_index(name), name, column)
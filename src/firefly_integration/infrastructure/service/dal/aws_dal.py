@@ -1,40 +1,89 @@
 from __future__ import annotations
 
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from hashlib import md5
-from typing import List, Tuple
+from threading import Lock, BoundedSemaphore
+from typing import List, Optional, Tuple, Union, Dict
 
 import awswrangler as wr
+import boto3
 import firefly as ff
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
 from botocore.exceptions import ClientError
 
 import firefly_integration.domain as domain
-from firefly_integration.domain.service.dal import Dal
-
-MAX_FILE_SIZE = 262144000  # 250MB
-MAX_RUN_TIME = 600  # 10 Minutes
-PARTITION_LOCK = 'partition-lock-{}'
+from firefly_integration.domain.service.dal import Dal, MAX_FILE_SIZE, MAX_RUN_TIME, PARTITION_LOCK
+from .arrow_criteria import dataset_schema, glue_expression, matching_rows, partition_fields, partition_matches, \
+    partition_values, partitioning, to_expression
+from .arrow_writer import PARQUET_OPTIONS, prepare_for_store, split_partitions
+from .bloom_filter import BloomFilter, build_filter, deserialize_filter, deserialize_index, index_path, \
+    lookup_hashes, merge_index, prune_files, serialize_filter, serialize_index, sidecar_path
+from .compaction_plan import CompactionTask, MASTER_FILE, plan_compaction
+from .duplicate_scan import duplicate_columns, find_duplicates
+from .glue_catalog import GlueCatalog
+from .partition_projection import enumerate_partitions
+from .streaming_compactor import StreamingCompactor
+
+MAX_LIST_THREADS = 16
+DEDUP_CHECKPOINT = '_dedup_checkpoint'
+DEDUP_CHECKPOINT_INTERVAL = 30
 
 
 class AwsDal(Dal, ff.LoggerAware):
     _batch_process: ff.BatchProcess = None
     _remove_duplicates: domain.RemoveDuplicates = None
+    _anti_join: domain.AntiJoin = None
     _sanitize_input_data: domain.SanitizeInputData = None
     _s3_client = None
     _mutex: ff.Mutex = None
-    _db_created: dict = {}
     _context: str = None
     _bucket: str = None
     _max_compact_records: str = None
+    _compact_concurrency: str = None
+    _compaction_mode: str = None
+    _compaction_memory_limit: str = None
+    _dedup_engine: str = None
+    _dedup_concurrency: str = None
+    _store_concurrency: str = None
+    _max_uploads: str = None
+    _s3_fs = None
 
     def __init__(self):
         super().__init__()
         if self._max_compact_records is None:
             self._max_compact_records = '1000'
+        if self._compaction_mode is None:
+            self._compaction_mode = 'memory'
+        if self._compact_concurrency is None:
+            # Each in-memory task can hold a whole target file in pandas, so only streaming compaction runs in parallel
+            # by default.
+            self._compact_concurrency = '1' if self._compaction_mode == 'memory' else '4'
+        if self._compaction_memory_limit is None:
+            self._compaction_memory_limit = str(256 * 1024 * 1024)
+        if self._dedup_engine is None:
+            self._dedup_engine = 'athena'
+        if self._dedup_concurrency is None:
+            self._dedup_concurrency = '4'
+        if self._store_concurrency is None:
+            self._store_concurrency = '8'
+        if self._max_uploads is None:
+            self._max_uploads = '32'
+        self._upload_slots = BoundedSemaphore(int(self._max_uploads))
+        self._glue_catalog = GlueCatalog()
+
+    def store(self, df: Union[pd.DataFrame, pa.Table], table: domain.Table):
+        self._glue_catalog.ensure_table(table, self._prepare_path(table.full_path()))
+        if isinstance(df, pa.Table):
+            return self._store_arrow(df, table)
 
-    def store(self, df: pd.DataFrame, table: domain.Table):
-        self._ensure_db_created(table)
         df = df[list(map(lambda c: c.name, table.columns)) + table.partitions]
 
         if 'created_on' in table.type_dict:
@@ -46,32 +95,127 @@ class AwsDal(Dal, ff.LoggerAware):
             'df': df,
             'path': table.full_path(),
             'dataset': True,
-            'database': table.database.name,
-            'table': table.name,
             'partition_cols': table.partitions.copy(),
-            'regular_partitions': True,
             'compression': 'snappy',
             'dtype': table.type_dict,
-            'schema_evolution': True,
         }
 
         if table.time_partitioning is not None:
             params['partition_cols'].append('dt')
-            df['dt'] = pd.to_datetime(df[table.time_partitioning_column]).dt.strftime(table.time_partition_format)
+            df['dt'] = table.time_partition_values(df[table.time_partitioning_column])
 
         if not df.empty:
-            wr.s3.to_parquet(**params)
+            with self._upload_slots:
+                result = wr.s3.to_parquet(**params)
+            self._glue_catalog.add_partitions(table, result['partitions_values'])
+            if table.duplicate_fields:
+                self._write_bloom_filters(df, table, params['partition_cols'], result)
+
+    def store_many(self, data: Dict[domain.Table, Union[pd.DataFrame, pa.Table]],
+                   max_workers: int = None) -> Dict[str, Exception]:
+        # Tables are written side by side; _max_uploads bounds the S3 writes in flight across all of them.
+        return super().store_many(data, max_workers or int(self._store_concurrency))
+
+    def _store_arrow(self, data: pa.Table, table: domain.Table):
+        data = prepare_for_store(data, table)
+        if data.num_rows == 0:
+            return
 
-    def load(self, table: domain.Table, criteria: ff.BinaryOp = None) -> pd.DataFrame:
-        pass
+        base = self._prepare_path(table.full_path())
+        writes = []
+        for partition, part in split_partitions(data, table):
+            directory = f'{base}/{partition}' if partition else base
+            writes.append((f'{directory}/{str(uuid.uuid4())}.snappy.parquet', part))
+
+        def write(w: Tuple[str, pa.Table]):
+            with self._upload_slots:
+                pq.write_table(w[1], w[0][len('s3://'):], filesystem=self._get_s3_fs(), **PARQUET_OPTIONS)
+            if table.duplicate_fields:
+                self._write_bloom_filter(w[1].select(table.duplicate_fields).to_pandas(), w[0], table)
+
+        with ThreadPoolExecutor(max_workers=min(len(writes), MAX_LIST_THREADS)) as executor:
+            list(executor.map(write, writes))
+
+        partitions = {}
+        for path, _ in writes:
+            directory = path.rsplit('/', 1)[0]
+            if directory != base:
+                partitions[f'{directory}/'] = [
+                    p.split('=', 1)[1] for p in directory[len(base) + 1:].split('/')
+                ]
+        self._glue_catalog.add_partitions(table, partitions)
+
+    def load(self, table: domain.Table, criteria: ff.BinaryOp = None, columns: List[str] = None) -> pd.DataFrame:
+        files = self._prune_by_key(table, self._list_table_objects(table, criteria), criteria)
+        if len(files) == 0:
+            return pd.DataFrame(columns=columns or list(map(lambda c: c.name, table.columns)))
+
+        return self._dataset(table, files).to_table(
+            columns=columns, filter=to_expression(criteria), use_threads=True
+        ).to_pandas()
 
     def delete(self, criteria: ff.BinaryOp, table: domain.Table):
-        pass
+        # The listing up front only picks the partitions to visit. Each partition is listed and pruned again under its
+        # lock, so a compaction can't replace the files we looked at with a master file we never checked.
+        files = self._prune_by_key(table, self._list_table_objects(table, criteria), criteria)
+        expression = to_expression(criteria)
+        for partition in sorted(set(map(lambda f: f.rsplit('/', 1)[0], files))):
+            path = self._prepare_path(partition)
+            try:
+                with self._mutex(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest())):
+                    self._delete_from_partition(table, path, criteria, expression)
+            except TimeoutError:
+                self.info(f'Could not acquire lock for {path}. Skipping.')
+
+    def _delete_from_partition(self, table: domain.Table, path: str, criteria: ff.BinaryOp, expression: ds.Expression):
+        objects = [o for o in self._list_objects(path) if o[1]['Key'].endswith('.parquet')]
+        files = self._prune_by_key(table, objects, criteria)
+        if len(files) == 0:
+            return
+
+        dataset = self._dataset(table, files)
+        for fragment in dataset.get_fragments(filter=expression):
+            # Row group statistics tell us which files can't possibly contain a match, so we don't download them.
+            if fragment.subset(filter=expression, schema=dataset.schema).num_row_groups == 0:
+                continue
+            self._delete_from_file(fragment, dataset.schema, criteria)
+
+    def _delete_from_file(self, fragment: ds.ParquetFileFragment, schema: pa.Schema, criteria: ff.BinaryOp):
+        rows = matching_rows(fragment, schema, criteria)
+        if len(rows) == 0:
+            return
+
+        p = f's3://{fragment.path}'
+        data = pq.read_table(fragment.path, filesystem=self._get_s3_fs())
+        if len(rows) == data.num_rows:
+            self.info(f'Deleting {p}')
+            wr.s3.delete_objects(path=[p])
+            return
+
+        self.info(f'Removing {len(rows)} rows from {p}')
+        self._remove_rows(data, rows, fragment.path)
+
+    def _remove_rows(self, data: pa.Table, rows: np.ndarray, path: str):
+        mask = np.ones(data.num_rows, dtype=bool)
+        mask[rows] = False
+        pq.write_table(data.filter(pa.array(mask)), f'{path}.tmp', filesystem=self._get_s3_fs(), **PARQUET_OPTIONS)
+        p = f's3://{path}'
+        dir_ = '/'.join(p.split('/')[0:-1]) + '/'
+        file_ = p.split('/')[-1]
+        wr.s3.copy_objects(paths=[f'{p}.tmp'], source_path=dir_, target_path=dir_, replace_filenames={
+            f'{file_}.tmp': file_,
+        })
+        wr.s3.delete_objects(path=[f'{p}.tmp'])
 
     def get_partitions(self, table: domain.Table, criteria: ff.BinaryOp = None) -> List[str]:
+        if table.projection_enabled:
+            base = self._prepare_path(table.full_path())[len('s3://'):]
+            return [f'{base}/{p}/' for p in enumerate_partitions(table, criteria)]
+
         args = {'database': table.database.name, 'table': table.name}
-        if criteria is not None:
-            args['expression'] = str(criteria)
+        expression = glue_expression(criteria, table)
+        if expression is not None:
+            args['expression'] = expression
 
         try:
             partitions = wr.catalog.get_parquet_partitions(**args)
@@ -80,6 +224,27 @@ class AwsDal(Dal, ff.LoggerAware):
 
         return list(map(lambda p: p.replace('s3://', ''), partitions.keys()))
 
+    def get_partitions_to_compact(self, table: domain.Table) -> List[str]:
+        if len(partition_fields(table)) == 0:
+            paths = [self._prepare_path(table.full_path())]
+        else:
+            paths = sorted(set(map(self._prepare_path, self.get_partitions(table))))
+
+        if len(paths) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(paths), MAX_LIST_THREADS)) as executor:
+            needs_compaction = list(executor.map(self._has_uncompacted_files, paths))
+
+        return [path for path, needed in zip(paths, needs_compaction) if needed]
+
+    def get_fingerprint(self, table: domain.Table, criteria: ff.BinaryOp = None) -> str:
+        ret = md5()
+        for bucket, o in sorted(self._list_table_objects(table, criteria), key=lambda x: x[1]['Key']):
+            ret.update(f'{bucket}/{o["Key"]}:{o["ETag"]};'.encode('utf-8'))
+
+        return ret.hexdigest()
+
     def wait_for_tmp_files(self, files: list):
         wr.s3.wait_objects_exist(
             list(map(lambda f: f's3://{self._bucket}/{f}', files)),
@@ -91,14 +256,43 @@ class AwsDal(Dal, ff.LoggerAware):
     def read_tmp_files(self, files: list) -> pd.DataFrame:
         return wr.s3.read_parquet(list(map(lambda f: f's3://{self._bucket}/{f}', files)), use_threads=True)
 
-    def write_tmp_file(self, file: str, data: pd.DataFrame):
-        wr.s3.to_parquet(data, path=f's3://{self._bucket}/{file}')
+    def read_files(self, files: List[str], columns: List[str] = None, criteria: ff.BinaryOp = None) -> pa.Table:
+        paths = list(map(lambda f: f.split('://', 1)[-1], files))
+
+        return ds.dataset(paths, format='parquet', filesystem=self._get_s3_fs()).to_table(
+            columns=columns, filter=to_expression(criteria), use_threads=True
+        )
+
+    def write_tmp_file(self, file: str, data: Union[pd.DataFrame, pa.Table]):
+        if isinstance(data, pa.Table):
+            pq.write_table(data, f'{self._bucket}/{file}', filesystem=self._get_s3_fs(), **PARQUET_OPTIONS)
+        else:
+            wr.s3.to_parquet(data, path=f's3://{self._bucket}/{file}')
 
     def deduplicate_partition(self, table: domain.Table, path: str):
         if table.duplicate_sort is None or table.duplicate_fields is None:
             return
 
         path = self._prepare_path(path)
+        plan = self._read_dedup_checkpoint(path)
+        if plan is not None:
+            self.info(f'Resuming de-duplication of {path}')
+        elif self._dedup_engine != 'native':
+            plan = self._plan_athena_dedup(table, path)
+            if plan.empty:
+                return
+
+        try:
+            with self._mutex(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest())):
+                if plan is None:
+                    plan = self._plan_native_dedup(table, path)
+                    if plan.empty:
+                        return
+                self._execute_dedup_plan(table, path, plan)
+        except TimeoutError:
+            pass
+
+    def _plan_athena_dedup(self, table: domain.Table, path: str) -> pd.DataFrame:
         dt = None
         for x in path.split('/'):
             if x.startswith('dt='):
@@ -136,135 +330,337 @@ order by {','.join(table.duplicate_fields)}
 
         df = wr.athena.read_sql_query(sql=sql, database=table.database.name, ctas_approach=False)
         if df.empty:
-            return
+            return df
 
         df.sort_values(by=table.duplicate_sort, inplace=True)
         df['duplicate'] = df.duplicated(subset=table.duplicate_fields, keep='last')
-        df = df[df['duplicate']]
+        df = df[df['duplicate']].drop(columns=['duplicate'])
         df['u'] = df['updated_on'].astype('datetime64[s]')
-        join_fields = table.duplicate_fields.copy() \
-            if isinstance(table.duplicate_fields, list) else [table.duplicate_fields]
-        join_fields.append('u')
+        sizes = {f's3://{bucket}/{o["Key"]}': o['Size'] for bucket, o in self._list_objects(path)}
+        df['$size'] = df['$path'].map(sizes)
 
-        try:
-            with self._mutex(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest())):
-                start = datetime.now()
-                for _, batch in df.groupby('$path'):
-                    if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
-                        self.info("We've been running for 10 minutes. Stopping now.")
-                        break
+        return df[table.duplicate_fields + ['u', '$path', '$size']].dropna(subset=['$size'])
 
-                    p = batch.iloc[0]['$path']
-                    print(f'Filtering {p}')
-                    f = wr.s3.read_parquet(path=p)
-                    if 'updated_on' not in f:
-                        self.info('No updated_on field in record set')
-                        continue
-                    f['u'] = f['updated_on'].astype('datetime64[s]')
-                    f = pd.merge(f, batch, indicator=True, how='outer', left_on=join_fields, right_on=join_fields)\
-                        .query('_merge == "left_only"')\
-                        .drop('_merge', axis=1)
-                    wr.s3.to_parquet(
-                        df=f, path=f'{p}.tmp', compression='snappy', dtype=table.type_dict, use_threads=True
-                    )
-                    dir_ = '/'.join(p.split('/')[0:-1]) + '/'
-                    file_ = p.split('/')[-1]
-                    wr.s3.copy_objects(paths=[f'{p}.tmp'], source_path=dir_, target_path=dir_, replace_filenames={
-                        f'{file_}.tmp': file_,
-                    })
-                    wr.s3.delete_objects(path=[f'{p}.tmp'])
-        except TimeoutError:
-            pass
+    def _plan_native_dedup(self, table: domain.Table, path: str) -> pd.DataFrame:
+        objects = [
+            (f'{bucket}/{o["Key"]}', o['Size']) for bucket, o in self._list_objects(path)
+            if o['Key'].endswith(MASTER_FILE)
+        ]
+        if len(objects) == 0:
+            return pd.DataFrame()
 
-    def compact(self, table: domain.Table, path: str):
-        self.info(f"Compacting {path}")
+        columns = duplicate_columns(table)
+        with ThreadPoolExecutor(max_workers=min(len(objects), MAX_LIST_THREADS)) as executor:
+            frames = list(executor.map(
+                lambda o: pq.read_table(o[0], columns=columns, filesystem=self._get_s3_fs()).to_pandas(), objects
+            ))
+
+        plan = [pd.DataFrame(columns=['$path', '$size', '$row'])]
+        for i, rows in find_duplicates(frames, table).items():
+            plan.append(pd.DataFrame({'$path': f's3://{objects[i][0]}', '$size': objects[i][1], '$row': rows}))
+
+        return pd.concat(plan, ignore_index=True)
+
+    def _execute_dedup_plan(self, table: domain.Table, path: str, plan: pd.DataFrame):
+        """
+        Rewrites the files in the plan in parallel. The part of the plan that is still outstanding is saved next to
+        the partition at most every DEDUP_CHECKPOINT_INTERVAL seconds and once more at the end, so a run that is cut
+        short picks up close to where it stopped. Files that changed since the plan was made are dropped from it
+        (which includes files a stale checkpoint still lists); the next full run will find their duplicates again.
+        """
+        sizes = {f's3://{bucket}/{o["Key"]}': o['Size'] for bucket, o in self._list_objects(path)}
+        remaining = {p: batch for p, batch in plan.groupby('$path')}
+        self._write_dedup_checkpoint(path, remaining)
+        lock = Lock()
+        checkpoint_lock = Lock()
         start = datetime.now()
-        while True:
-            if self._do_compact(table, path) is True:
-                break
+        last_checkpoint = [start]
+
+        def checkpoint():
+            # Only one thread writes at a time, and the others don't wait for it. The snapshot is taken while holding
+            # checkpoint_lock so an older snapshot can never overwrite a newer one.
+            if not checkpoint_lock.acquire(blocking=False):
+                return
+            try:
+                with lock:
+                    if (datetime.now() - last_checkpoint[0]).total_seconds() < DEDUP_CHECKPOINT_INTERVAL:
+                        return
+                    last_checkpoint[0] = datetime.now()
+                    snapshot = dict(remaining)
+                self._write_dedup_checkpoint(path, snapshot)
+            finally:
+                checkpoint_lock.release()
+
+        def rewrite(p: str):
             if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
-                self.info("We've been running for 10 minutes. Stopping now.")
-                break
+                return
+            batch = remaining[p]
+            if sizes.get(p) == batch['$size'].iloc[0]:
+                self.info(f'Filtering {p}')
+                self._dedup_file(table, p, batch)
+            with lock:
+                del remaining[p]
+            checkpoint()
 
-    def _do_compact(self, table: domain.Table, path: str) -> bool:
-        path = self._prepare_path(path)
-        parts = path.split('/')
-        bucket = parts[2]
-        p = '/'.join(parts[3:])
-        key, key_exists, num_master_records, master_record_size = self._find_master_record(bucket, p)
-        to_compact = self._find_files_to_compact(bucket, p, num_master_records, master_record_size)
+        try:
+            with ThreadPoolExecutor(max_workers=int(self._dedup_concurrency)) as executor:
+                for future in [executor.submit(rewrite, p) for p in list(remaining.keys())]:
+                    future.result()
+        finally:
+            self._write_dedup_checkpoint(path, remaining)
+
+        if len(remaining) > 0:
+            self.info("We've been running for 10 minutes. Stopping now.")
+
+    def _dedup_file(self, table: domain.Table, p: str, batch: pd.DataFrame):
+        if '$row' in batch:
+            path = p[len('s3://'):]
+            self._remove_rows(
+                pq.read_table(path, filesystem=self._get_s3_fs()), batch['$row'].values.astype(np.int64), path
+            )
+            return
 
-        if len(to_compact) == 0:
-            return True  # Nothing new to compact
+        f = wr.s3.read_parquet(path=p)
+        if 'updated_on' not in f:
+            self.info('No updated_on field in record set')
+            return
+        f['u'] = f['updated_on'].astype('datetime64[s]')
+        f = self._anti_join(f, batch, table.duplicate_fields + ['u']).drop(columns=['u'])
+        wr.s3.to_parquet(
+            df=f, path=f'{p}.tmp', compression='snappy', dtype=table.type_dict, use_threads=True
+        )
+        dir_ = '/'.join(p.split('/')[0:-1]) + '/'
+        file_ = p.split('/')[-1]
+        wr.s3.copy_objects(paths=[f'{p}.tmp'], source_path=dir_, target_path=dir_, replace_filenames={
+            f'{file_}.tmp': file_,
+        })
+        wr.s3.delete_objects(path=[f'{p}.tmp'])
+
+    def _read_dedup_checkpoint(self, path: str) -> Optional[pd.DataFrame]:
+        try:
+            return pq.read_table(f'{path}/{DEDUP_CHECKPOINT}'[len('s3://'):], filesystem=self._get_s3_fs())\
+                .to_pandas()
+        except (FileNotFoundError, OSError):
+            return None
+
+    def _write_dedup_checkpoint(self, path: str, remaining: dict):
+        checkpoint = f'{path}/{DEDUP_CHECKPOINT}'
+        if len(remaining) == 0:
+            wr.s3.delete_objects(path=[checkpoint])
+            return
 
-        to_read = to_compact.copy()
-        if key_exists:
-            to_read.append(f's3://{bucket}/{key}')
+        pq.write_table(
+            pa.Table.from_pandas(pd.concat(remaining.values(), ignore_index=True), preserve_index=False),
+            checkpoint[len('s3://'):], filesystem=self._get_s3_fs(), compression='snappy'
+        )
 
+    def compact(self, table: domain.Table, path: str, start: datetime = None):
+        start = start or datetime.now()
+        if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
+            return
+        self.info(f"Compacting {path}")
+        path = self._prepare_path(path)
         try:
-            print(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest()))
             with self._mutex(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest()), timeout=0):
-                try:
-                    df = self._sanitize_input_data(wr.s3.read_parquet(path=to_read, use_threads=True), table)
-                except ClientError:
-                    return True  # Another process must be compacting, so stop running
-
-                self._remove_duplicates(df, table)
-                try:
-                    df.reset_index(inplace=True)
-                except ValueError:
-                    pass
-                wr.s3.to_parquet(
-                    df=df, path=f's3://{bucket}/{key}.tmp', compression='snappy', dtype=table.type_dict,
-                    use_threads=True
-                )
-                self._s3_client.copy_object(Bucket=bucket, CopySource=f'{bucket}/{key}.tmp', Key=key)
-                self._s3_client.delete_object(Bucket=bucket, Key=f'{key}.tmp')
-                wr.s3.delete_objects(to_compact, use_threads=True)
-
-                self.info(f'Compacted {len(to_compact)} records')
+                while True:
+                    plan = self._plan_compaction(path)
+                    if len(plan) == 0:
+                        break  # Nothing new to compact
+                    self._execute_compaction_plan(table, plan, start)
+                    if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
+                        self.info("We've been running for 10 minutes. Stopping now.")
+                        break
+                self._write_bloom_index(table, path)
         except TimeoutError:
-            return True
+            pass  # Another process must be compacting
 
-        return False
+    def _plan_compaction(self, path: str) -> List[CompactionTask]:
+        objects = [(f's3://{bucket}/{o["Key"]}', o['Size']) for bucket, o in self._list_objects(path)]
+
+        return plan_compaction(path, objects, MAX_FILE_SIZE, int(self._max_compact_records))
+
+    def _execute_compaction_plan(self, table: domain.Table, plan: List[CompactionTask], start: datetime):
+        with ThreadPoolExecutor(max_workers=int(self._compact_concurrency)) as executor:
+            for future in [executor.submit(self._run_compaction_task, table, task, start) for task in plan]:
+                future.result()
+
+    def _run_compaction_task(self, table: domain.Table, task: CompactionTask, start: datetime):
+        if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
+            return
+
+        to_read = task.files.copy()
+        if task.target_exists:
+            to_read.append(task.target)
 
-    def _find_master_record(self, bucket: str, key: str) -> Tuple[str, bool, int, int]:
-        x = 1
-        while True:
+        parts = task.target.split('/')
+        bucket = parts[2]
+        key = '/'.join(parts[3:])
+
+        if self._compaction_mode == 'streaming':
+            compactor = StreamingCompactor(
+                self._sanitize_input_data, self._remove_duplicates, int(self._compaction_memory_limit)
+            )
+            try:
+                compactor(
+                    table, [f[len('s3://'):] for f in to_read], f'{bucket}/{key}.tmp', self._get_s3_fs()
+                )
+            except (FileNotFoundError, OSError) as e:
+                self.info(f'Could not compact into {task.target}: {str(e)}')
+                return
+            keys = None
+            if table.duplicate_fields:
+                keys = pq.read_table(
+                    f'{bucket}/{key}.tmp', columns=table.duplicate_fields, filesystem=self._get_s3_fs()
+                ).to_pandas()
+        else:
             try:
-                response = self._s3_client.head_object(Bucket=bucket, Key=f'{key}/{x}.dat.snappy.parquet')
-                if int(response['ContentLength']) < MAX_FILE_SIZE:
-                    return f'{key}/{x}.dat.snappy.parquet', True, x, int(response['ContentLength'])
+                df = self._sanitize_input_data(wr.s3.read_parquet(path=to_read, use_threads=True), table)
             except ClientError:
-                return f'{key}/{x}.dat.snappy.parquet', False, x, 0
-            x += 1
-
-    def _find_files_to_compact(self, bucket: str, key: str, num_master_records: int, master_record_size: int):
-        response = self._s3_client.list_objects_v2(
-            Bucket=bucket,
-            Prefix=f'{key}/',
-            MaxKeys=int(self._max_compact_records) + num_master_records
-        )
+                return
+
+            self._remove_duplicates(df, table)
+            try:
+                df.reset_index(inplace=True)
+            except ValueError:
+                pass
+
+            wr.s3.to_parquet(
+                df=df, path=f'{task.target}.tmp', compression='snappy', dtype=table.type_dict, use_threads=True
+            )
+            keys = df
+        self._s3_client.copy_object(Bucket=bucket, CopySource=f'{bucket}/{key}.tmp', Key=key)
+        self._s3_client.delete_object(Bucket=bucket, Key=f'{key}.tmp')
+        if keys is not None and table.duplicate_fields:
+            self._write_bloom_filter(keys, task.target, table)
+        wr.s3.delete_objects(task.files + list(map(sidecar_path, task.files)), use_threads=True)
+
+        self.info(f'Compacted {len(task.files)} records into {task.target}')
+
+    def _list_table_objects(self, table: domain.Table, criteria: ff.BinaryOp = None) -> List[Tuple[str, dict]]:
+        if len(partition_fields(table)) == 0:
+            paths = [self._prepare_path(table.full_path())]
+        else:
+            # Glue filters on the partition-only part of the criteria; the rest is checked here.
+            paths = [
+                self._prepare_path(p) for p in self.get_partitions(table, criteria)
+                if partition_matches(criteria, partition_values(p), table)
+            ]
+
+        if len(paths) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(paths), MAX_LIST_THREADS)) as executor:
+            listings = executor.map(self._list_objects, paths)
+
+        return [o for listing in listings for o in listing if o[1]['Key'].endswith('.parquet')]
+
+    def _list_objects(self, path: str) -> List[Tuple[str, dict]]:
+        parts = self._prepare_path(path).split('/')
+        bucket = parts[2]
         ret = []
-        total = master_record_size
-        try:
-            for f in response['Contents']:
-                if '.dat.snappy.parquet' in f['Key']:
-                    continue
-                total += f['Size']
-                ret.append(f's3://{bucket}/{f["Key"]}')
-                if total > MAX_FILE_SIZE:
-                    break
-        except KeyError:
-            pass
+        for page in self._s3_client.get_paginator('list_objects_v2').paginate(
+                Bucket=bucket, Prefix='/'.join(parts[3:]) + '/'):
+            ret.extend((bucket, o) for o in page.get('Contents', []))
 
         return ret
 
-    def _ensure_db_created(self, table: domain.Table):
-        if table.database.name not in self._db_created:
-            wr.catalog.create_database(name=table.database.name, exist_ok=True,
-                                       description=table.database.description or '')
-            self._db_created[table.database.name] = True
+    def _has_uncompacted_files(self, path: str) -> bool:
+        parts = path.split('/')
+        # Delimited listing only returns the partition's own files, and we can stop at the first page that has one.
+        for page in self._s3_client.get_paginator('list_objects_v2').paginate(
+                Bucket=parts[2], Prefix='/'.join(parts[3:]) + '/', Delimiter='/'):
+            for o in page.get('Contents', []):
+                if o['Key'].endswith('.parquet') and not o['Key'].endswith(MASTER_FILE):
+                    return True
+
+        return False
+
+    def _write_bloom_filters(self, df: pd.DataFrame, table: domain.Table, partition_cols: list, result: dict):
+        groups = {}
+        if len(partition_cols) > 0:
+            for values, group in df.groupby(partition_cols, sort=False, observed=True, dropna=False):
+                groups[tuple(map(str, values if isinstance(values, tuple) else (values,)))] = group
+        prefixes = {prefix.rstrip('/'): tuple(values) for prefix, values in result['partitions_values'].items()}
+
+        for path in result['paths']:
+            if len(partition_cols) == 0:
+                data = df
+            else:
+                data = groups.get(prefixes.get(path.rsplit('/', 1)[0]))
+            if data is None:  # Couldn't match the file to its partition, so read its keys back
+                data = pq.read_table(
+                    path[len('s3://'):], columns=table.duplicate_fields, filesystem=self._get_s3_fs()
+                ).to_pandas()
+            self._write_bloom_filter(data, path, table)
+
+    def _write_bloom_filter(self, df: pd.DataFrame, path: str, table: domain.Table):
+        with self._get_s3_fs().open_output_stream(sidecar_path(path)[len('s3://'):]) as fp:
+            fp.write(serialize_filter(build_filter(df, table)))
+
+    def _read_bloom_filter(self, path: str) -> Optional[BloomFilter]:
+        try:
+            with self._get_s3_fs().open_input_stream(sidecar_path(path)[len('s3://'):]) as fp:
+                return deserialize_filter(fp.read())
+        except (FileNotFoundError, OSError):
+            return None
+
+    def _read_bloom_index(self, path: str) -> dict:
+        try:
+            with self._get_s3_fs().open_input_file(index_path(path)[len('s3://'):]) as fp:
+                return deserialize_index(fp)
+        except (FileNotFoundError, OSError):
+            return {}
+
+    def _write_bloom_index(self, table: domain.Table, path: str):
+        if not table.duplicate_fields:
+            return
+
+        masters = [
+            (f's3://{bucket}/{o["Key"]}', o['Size']) for bucket, o in self._list_objects(path)
+            if o['Key'].endswith(MASTER_FILE)
+        ]
+        index = merge_index(masters, self._read_bloom_index(path), self._read_bloom_filter)
+        with self._get_s3_fs().open_output_stream(index_path(path)[len('s3://'):]) as fp:
+            fp.write(serialize_index(index))
+        indexed = [sidecar_path(f) for f, _ in masters if os.path.basename(f) in index]
+        if len(indexed) > 0:
+            wr.s3.delete_objects(indexed, use_threads=True)
+
+    def _prune_by_key(self, table: domain.Table, objects: List[Tuple[str, dict]],
+                      criteria: ff.BinaryOp = None) -> List[str]:
+        files = [(f's3://{bucket}/{o["Key"]}', o['Size']) for bucket, o in objects]
+        hashes = lookup_hashes(criteria, table)
+        if hashes is None:
+            return list(map(lambda f: f[0], files))
+
+        directories = {}
+        for file in files:
+            directories.setdefault(file[0].rsplit('/', 1)[0], []).append(file)
+        if len(directories) == 0:
+            return []
+
+        def prune(directory: str):
+            return prune_files(
+                directories[directory], hashes, self._read_bloom_index(directory), self._read_bloom_filter
+            )
+
+        with ThreadPoolExecutor(max_workers=min(len(directories), MAX_LIST_THREADS)) as executor:
+            return [f for kept in executor.map(prune, list(directories.keys())) for f in kept]
+
+    def _dataset(self, table: domain.Table, files: List[str]) -> ds.Dataset:
+        return ds.dataset(
+            list(map(lambda f: f.replace('s3://', ''), files)),
+            schema=dataset_schema(table),
+            format='parquet',
+            filesystem=self._get_s3_fs(),
+            partitioning=partitioning(table),
+            partition_base_dir=table.full_path()
+        )
+
+    def _get_s3_fs(self):
+        if self._s3_fs is None:
+            self._s3_fs = fs.S3FileSystem(region=boto3.session.Session().region_name)
+        return self._s3_fs
 
     def _prepare_path(self, path: str):
         path = path.rstrip('/')
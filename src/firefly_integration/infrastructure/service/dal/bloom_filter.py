@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import math
+import os
+from datetime import datetime, date
+from itertools import product
+from typing import Callable, Dict, List, Optional, Tuple
+
+import firefly as ff
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import firefly_integration.domain as domain
+
+FALSE_POSITIVE_RATE = 0.01
+MAX_LOOKUP_KEYS = 10000
+BLOOM_INDEX = '_bloom_index'  # Leading underscore keeps Athena / Glue from treating these as data files
+
+
+class BloomFilter:
+    """
+    A plain bloom filter over 64-bit key hashes, using double hashing to derive the bit positions.
+    """
+
+    def __init__(self, bits: np.ndarray, num_hashes: int):
+        self.bits = bits
+        self.num_hashes = num_hashes
+
+    @classmethod
+    def for_capacity(cls, n: int, false_positive_rate: float = FALSE_POSITIVE_RATE) -> BloomFilter:
+        n = max(n, 1)
+        m = max(64, int(math.ceil(-n * math.log(false_positive_rate) / (math.log(2) ** 2))))
+        m += -m % 8
+        return cls(np.zeros(m, dtype=bool), max(1, int(round(m / n * math.log(2)))))
+
+    def add(self, hashes: np.ndarray):
+        self.bits[self._positions(hashes)] = True
+
+    def might_contain(self, hashes: np.ndarray) -> np.ndarray:
+        return self.bits[self._positions(hashes)].all(axis=1)
+
+    def to_bytes(self) -> bytes:
+        return np.packbits(self.bits).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, num_hashes: int) -> BloomFilter:
+        return cls(np.unpackbits(np.frombuffer(data, dtype=np.uint8)).astype(bool), num_hashes)
+
+    def _positions(self, hashes: np.ndarray) -> np.ndarray:
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        h1 = hashes & np.uint64(0xffffffff)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.num_hashes, dtype=np.uint64)
+        return ((h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(len(self.bits))).astype(np.int64)
+
+
+def key_hashes(df: pd.DataFrame, table: domain.Table) -> np.ndarray:
+    """
+    Hashes the duplicate_fields of each row. Values are normalized by column type first, so keys taken from query
+    criteria hash the same way as the stored data.
+    """
+    keys = pd.DataFrame({
+        name: _normalize(df[name], table.get_column(name).data_type) for name in table.duplicate_fields
+    })
+
+    return pd.util.hash_pandas_object(keys, index=False).values
+
+
+def build_filter(df: pd.DataFrame, table: domain.Table) -> BloomFilter:
+    df = df.dropna(subset=table.duplicate_fields)
+    ret = BloomFilter.for_capacity(len(df))
+    if len(df) > 0:
+        ret.add(key_hashes(df, table))
+
+    return ret
+
+
+def lookup_hashes(criteria: Optional[ff.BinaryOp], table: domain.Table) -> Optional[np.ndarray]:
+    """
+    Returns the key hashes a query is restricted to, when the criteria pin every duplicate field to one or more
+    values (== or in, joined with and). Returns None when the criteria can't be used for a key lookup.
+    """
+    if criteria is None or not table.duplicate_fields:
+        return None
+
+    values = _key_values(criteria)
+    if values is None or any(f not in values for f in table.duplicate_fields):
+        return None
+
+    if np.prod([len(values[f]) for f in table.duplicate_fields]) > MAX_LOOKUP_KEYS:
+        return None
+
+    df = pd.DataFrame(
+        list(product(*[values[f] for f in table.duplicate_fields])), columns=table.duplicate_fields
+    )
+    if df.empty:
+        return np.array([], dtype=np.uint64)
+
+    try:
+        return key_hashes(df, table)
+    except (ValueError, TypeError):
+        return None
+
+
+def sidecar_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'_{name}.bloom')
+
+
+def index_path(directory: str) -> str:
+    return os.path.join(directory, BLOOM_INDEX)
+
+
+def serialize_index(filters: Dict[str, Tuple[BloomFilter, int]]) -> pa.Buffer:
+    names = sorted(filters.keys())
+    data = pa.table({
+        'file': pa.array(names, pa.string()),
+        'size': pa.array([filters[n][1] for n in names], pa.int64()),
+        'num_hashes': pa.array([filters[n][0].num_hashes for n in names], pa.int32()),
+        'bits': pa.array([filters[n][0].to_bytes() for n in names], pa.binary()),
+    })
+    sink = pa.BufferOutputStream()
+    pq.write_table(data, sink, compression='snappy')
+
+    return sink.getvalue()
+
+
+def deserialize_index(source) -> Dict[str, Tuple[BloomFilter, int]]:
+    data = pq.read_table(source).to_pydict()
+
+    return {
+        name: (BloomFilter.from_bytes(bits, num_hashes), size)
+        for name, size, num_hashes, bits in zip(data['file'], data['size'], data['num_hashes'], data['bits'])
+    }
+
+
+def serialize_filter(bloom_filter: BloomFilter) -> bytes:
+    return bytes([bloom_filter.num_hashes]) + bloom_filter.to_bytes()
+
+
+def deserialize_filter(data: bytes) -> BloomFilter:
+    return BloomFilter.from_bytes(data[1:], data[0])
+
+
+def prune_files(files: List[Tuple[str, int]], hashes: np.ndarray, indexed: Dict[str, Tuple[BloomFilter, int]],
+                read_sidecar: Callable[[str], Optional[BloomFilter]]) -> List[str]:
+    """
+    Drops the files whose filter rules out every key. Index entries are only trusted while the file still has the
+    size it had when it was indexed, otherwise the file's own sidecar is read. Files without a usable filter are
+    always kept.
+    """
+    ret = []
+    for path, size in files:
+        name = os.path.basename(path)
+        if name in indexed and indexed[name][1] == size:
+            bloom_filter = indexed[name][0]
+        else:
+            bloom_filter = read_sidecar(path)
+        if bloom_filter is None or bloom_filter.might_contain(hashes).any():
+            ret.append(path)
+
+    return ret
+
+
+def merge_index(masters: List[Tuple[str, int]], indexed: Dict[str, Tuple[BloomFilter, int]],
+                read_sidecar: Callable[[str], Optional[BloomFilter]]) -> Dict[str, Tuple[BloomFilter, int]]:
+    """
+    Builds a partition index over the master files. A sidecar is written whenever rows are added to a file, so it
+    always wins over the index. An index entry with a stale size is still kept otherwise, because the only other
+    rewrites (delete, de-duplication) remove rows and leave the old filter a superset of the file's keys.
+    """
+    ret = {}
+    for path, size in masters:
+        name = os.path.basename(path)
+        bloom_filter = read_sidecar(path)
+        if bloom_filter is None and name in indexed:
+            bloom_filter = indexed[name][0]
+        if bloom_filter is not None:
+            ret[name] = (bloom_filter, size)
+
+    return ret
+
+
+def _key_values(criteria: ff.BinaryOp) -> Optional[dict]:
+    if criteria.op == 'and':
+        ret = {}
+        for side in (criteria.lhv, criteria.rhv):
+            if isinstance(side, ff.BinaryOp):
+                values = _key_values(side)
+                for k, v in (values or {}).items():
+                    ret[k] = [x for x in ret[k] if x in v] if k in ret else v
+        return ret
+
+    lhv, rhv = criteria.lhv, criteria.rhv
+    if not isinstance(lhv, (ff.Attr, ff.AttributeString)):
+        lhv, rhv = rhv, lhv
+    if not isinstance(lhv, (ff.Attr, ff.AttributeString)) or isinstance(rhv, (ff.Attr, ff.AttributeString)):
+        return {} if criteria.op != 'or' else None
+
+    if criteria.op == '==' and rhv is not None:
+        return {str(lhv): [rhv]}
+    if criteria.op == 'in':
+        return {str(lhv): list(rhv)}
+
+    return {} if criteria.op != 'or' else None
+
+
+def _normalize(series: pd.Series, data_type: type) -> pd.Series:
+    if data_type in (datetime, date):
+        return pd.to_datetime(series).dt.tz_localize(None).astype('datetime64[ns]').astype('int64').astype(str)
+    if data_type is int:
+        return series.astype(np.float64).astype('Int64').astype(str)
+    if data_type is float:
+        return series.astype(np.float64).astype(str)
+    if data_type is bool:
+        return series.astype(bool).astype(str)
+
+    return series.astype(str)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from typing import List, Tuple
+
+MASTER_FILE = '.dat.snappy.parquet'
+
+
+class CompactionTask:
+    target: str = None
+    target_exists: bool = False
+    target_size: int = 0
+    files: List[str] = None
+    size: int = 0
+
+    def __init__(self, target: str, target_exists: bool = False, target_size: int = 0):
+        self.target = target
+        self.target_exists = target_exists
+        self.target_size = target_size
+        self.files = []
+        self.size = target_size
+
+    def add(self, file: str, size: int):
+        self.files.append(file)
+        self.size += size
+
+    def __repr__(self):
+        return f'CompactionTask({self.target}, {len(self.files)} files, {self.size} bytes)'
+
+
+def plan_compaction(prefix: str, objects: List[Tuple[str, int]], max_file_size: int,
+                    max_files: int = None) -> List[CompactionTask]:
+    """
+    Bin-packs every small file in a partition (objects are (path, size) tuples) into master files. Master files that
+    still have room are topped up first, then new ones are numbered after the highest existing master. The tasks
+    touch disjoint files, so they can be executed in parallel.
+    """
+    masters = {}
+    small = []
+    for path, size in objects:
+        if path.rsplit('/', 1)[0] != prefix:
+            continue  # Belongs to a sub-partition
+        name = path.split('/')[-1]
+        if name.endswith(MASTER_FILE):
+            try:
+                masters[int(name[:-len(MASTER_FILE)])] = (path, size)
+            except ValueError:
+                continue
+        elif name.endswith('.parquet'):
+            small.append((path, size))
+
+    if len(small) == 0:
+        return []
+
+    bins = [CompactionTask(path, True, size) for _, (path, size) in sorted(masters.items()) if size < max_file_size]
+    next_master = max(masters.keys(), default=0) + 1
+
+    # First-fit decreasing
+    for path, size in sorted(small, key=lambda s: s[1], reverse=True):
+        for task in bins:
+            if task.size + size <= max_file_size and (max_files is None or len(task.files) < max_files):
+                task.add(path, size)
+                break
+        else:
+            task = CompactionTask(f'{prefix}/{next_master}{MASTER_FILE}')
+            next_master += 1
+            task.add(path, size)
+            bins.append(task)
+
+    return list(filter(lambda t: len(t.files) > 0, bins))
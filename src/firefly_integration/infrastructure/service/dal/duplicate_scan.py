@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+import firefly_integration.domain as domain
+
+
+def duplicate_columns(table: domain.Table) -> list:
+    return table.duplicate_fields + [c for c in table.duplicate_sort if c not in table.duplicate_fields]
+
+
+def find_duplicates(frames: List[pd.DataFrame], table: domain.Table) -> Dict[int, np.ndarray]:
+    """
+    Takes the duplicate_fields / duplicate_sort columns of each file in a partition and returns, per file index, the
+    row positions that are superseded by a later version of the same key. Keys are hashed first so that only rows
+    whose key occurs more than once are sorted.
+    """
+    parts = []
+    for i, frame in enumerate(frames):
+        parts.append(frame.assign(**{'$file': i, '$row': np.arange(len(frame))}))
+    if len(parts) == 0:
+        return {}
+
+    df = pd.concat(parts, ignore_index=True).dropna(subset=table.duplicate_fields)
+    if df.empty:
+        return {}
+
+    hashes = pd.util.hash_pandas_object(df[table.duplicate_fields], index=False)
+    df = df[hashes.duplicated(keep=False).values]
+    if df.empty:
+        return {}
+
+    df = df.sort_values(by=table.duplicate_sort, kind='stable')
+    df = df[df.duplicated(subset=table.duplicate_fields, keep='last')]
+
+    return {i: batch['$row'].values for i, batch in df.groupby('$file')}
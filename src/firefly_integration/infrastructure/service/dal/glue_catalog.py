@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+from hashlib import md5
+from threading import Lock
+from typing import Dict, List, Optional
+
+import awswrangler as wr
+from botocore.exceptions import ClientError
+
+import firefly_integration.domain as domain
+from .arrow_criteria import partition_fields
+from .partition_projection import projection_parameters
+
+PARTITION_BATCH_SIZE = 100
+
+
+class GlueCatalog:
+    """
+    Keeps the Glue catalog in step with what AwsDal writes, while calling Glue as little as possible. Per process it
+    remembers which databases exist, the schema hash each table was last synced with, and the partitions each table
+    is known to have. A write only reaches Glue when a table's schema changed or it produced partitions we haven't
+    seen, and new partitions are registered in batches of PARTITION_BATCH_SIZE. Tables with partition projection never
+    have partitions registered.
+    """
+
+    def __init__(self):
+        self._databases = set()
+        self._schemas: Dict[str, str] = {}
+        self._partitions: Dict[str, set] = {}
+        self._lock = Lock()
+
+    def ensure_table(self, table: domain.Table, path: str):
+        key = self._key(table)
+        signature = self.schema_hash(table)
+        if self._schemas.get(key) == signature:
+            return
+
+        with self._lock:
+            if self._schemas.get(key) == signature:
+                return
+            self._ensure_database(table.database)
+            fields = partition_fields(table)
+            types = table.type_dict
+            columns = {k: v for k, v in types.items() if k not in fields}
+            partitions = {f: types.get(f, 'string') for f in fields}
+            catalog = self._catalog_types(table)
+            if catalog is None or any(catalog.get(k) != v for k, v in {**columns, **partitions}.items()):
+                wr.catalog.create_parquet_table(
+                    database=table.database.name,
+                    table=table.name,
+                    path=f'{path.rstrip("/")}/',
+                    columns_types=columns,
+                    partitions_types=partitions,
+                    compression='snappy',
+                    parameters=projection_parameters(table, path),
+                    mode='overwrite' if catalog is None else 'update',
+                )
+            self._schemas[key] = signature
+
+    def add_partitions(self, table: domain.Table, partitions: Dict[str, List[str]]):
+        """
+        Takes {s3 location: [partition values]} and registers the ones Glue doesn't have yet.
+        """
+        if len(partitions) == 0 or table.projection_enabled:
+            return
+
+        key = self._key(table)
+        known = self._known_partitions(table)
+        new = {self._location(k): v for k, v in partitions.items() if self._location(k) not in known}
+        if len(new) == 0:
+            return
+
+        items = list(new.items())
+        for i in range(0, len(items), PARTITION_BATCH_SIZE):
+            wr.catalog.add_parquet_partitions(
+                database=table.database.name, table=table.name,
+                partitions_values=dict(items[i:i + PARTITION_BATCH_SIZE]), compression='snappy'
+            )
+        with self._lock:
+            self._partitions[key].update(new.keys())
+
+    def forget(self, table: domain.Table):
+        with self._lock:
+            self._schemas.pop(self._key(table), None)
+            self._partitions.pop(self._key(table), None)
+
+    @staticmethod
+    def schema_hash(table: domain.Table) -> str:
+        fields = partition_fields(table)
+        return md5(repr((sorted(table.type_dict.items()), fields)).encode('utf-8')).hexdigest()
+
+    def _ensure_database(self, database: domain.Database):
+        if database.name not in self._databases:
+            wr.catalog.create_database(name=database.name, exist_ok=True, description=database.description or '')
+            self._databases.add(database.name)
+
+    def _known_partitions(self, table: domain.Table) -> set:
+        key = self._key(table)
+        if key not in self._partitions:
+            try:
+                existing = wr.catalog.get_parquet_partitions(database=table.database.name, table=table.name)
+            except ClientError:
+                existing = {}
+            with self._lock:
+                self._partitions.setdefault(key, set()).update(map(self._location, existing.keys()))
+
+        return self._partitions[key]
+
+    @staticmethod
+    def _catalog_types(table: domain.Table) -> Optional[dict]:
+        # None when the table doesn't exist yet.
+        try:
+            return wr.catalog.get_table_types(database=table.database.name, table=table.name)
+        except ClientError:
+            return None
+
+    @staticmethod
+    def _location(path: str) -> str:
+        return f'{path.rstrip("/")}/'
+
+    @staticmethod
+    def _key(table: domain.Table) -> str:
+        return f'{table.database.name}.{table.name}'
@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import md5
+from time import sleep
+from typing import List, Optional, Union
+
+import firefly as ff
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+
+import firefly_integration.domain as domain
+from firefly_integration.domain.service.dal import Dal, MAX_FILE_SIZE, MAX_RUN_TIME, PARTITION_LOCK
+from .arrow_criteria import dataset_schema, file_schema, matching_rows, partition_fields, partitioning, \
+    partition_matches, partition_values, to_expression
+from .arrow_writer import PARQUET_OPTIONS, prepare_for_store, split_partitions
+from .bloom_filter import BloomFilter, build_filter, deserialize_filter, deserialize_index, index_path, \
+    lookup_hashes, merge_index, prune_files, serialize_filter, serialize_index, sidecar_path
+from .compaction_plan import CompactionTask, MASTER_FILE, plan_compaction
+from .duplicate_scan import duplicate_columns, find_duplicates
+from .streaming_compactor import StreamingCompactor
+
+
+class LocalDal(Dal, ff.LoggerAware):
+    """
+    Stores tables on the local filesystem, using the same hive-style layout that AwsDal writes to S3. Reads are
+    memory-mapped, so large partitions can be scanned without copying the files into the heap first.
+    """
+    _remove_duplicates: domain.RemoveDuplicates = None
+    _sanitize_input_data: domain.SanitizeInputData = None
+    _mutex: ff.Mutex = None
+    _local_data_path: str = None
+    _compact_concurrency: str = None
+    _compaction_mode: str = None
+    _compaction_memory_limit: str = None
+
+    def __init__(self):
+        super().__init__()
+        if self._local_data_path is None:
+            self._local_data_path = os.path.join(tempfile.gettempdir(), 'firefly-integration')
+        if self._compaction_mode is None:
+            self._compaction_mode = 'memory'
+        if self._compact_concurrency is None:
+            # Each in-memory task can hold a whole target file in pandas, so only streaming compaction runs in parallel
+            # by default.
+            self._compact_concurrency = '1' if self._compaction_mode == 'memory' else '4'
+        if self._compaction_memory_limit is None:
+            self._compaction_memory_limit = str(256 * 1024 * 1024)
+        self._local_data_path = self._local_data_path.rstrip('/')
+        self._fs = fs.LocalFileSystem(use_mmap=True)
+
+    def store(self, df: Union[pd.DataFrame, pa.Table], table: domain.Table):
+        if isinstance(df, pa.Table):
+            return self._store_arrow(df, table)
+
+        columns = list(map(lambda c: c.name, table.columns))
+        df = df[columns + [p for p in table.partitions if p not in columns and p in df]].copy()
+
+        if 'created_on' in table.type_dict:
+            df['created_on'] = df['created_on'].fillna(datetime.utcnow())
+        if 'updated_on' in table.type_dict:
+            df['updated_on'] = datetime.utcnow()
+
+        if df.empty:
+            return
+
+        base = self._table_path(table)
+        fields = table.partition_names
+        for values, group in table.partition_groups(df):
+            partition = '/'.join(f'{k}={self._partition_value(v)}' for k, v in zip(fields, values))
+            self._write_file(group, os.path.join(base, partition, f'{str(uuid.uuid4())}.snappy.parquet'), table)
+
+    def _store_arrow(self, data: pa.Table, table: domain.Table):
+        data = prepare_for_store(data, table)
+        if data.num_rows == 0:
+            return
+
+        base = self._table_path(table)
+        for partition, part in split_partitions(data, table):
+            path = os.path.join(base, partition, f'{str(uuid.uuid4())}.snappy.parquet')
+            self._replace_file(part, path)
+            if table.duplicate_fields:
+                self._write_bloom_filter(part.select(table.duplicate_fields).to_pandas(), path, table)
+
+    def load(self, table: domain.Table, criteria: ff.BinaryOp = None, columns: List[str] = None) -> pd.DataFrame:
+        files = self._prune_by_key(table, self._list_table_files(table, criteria), criteria)
+        if len(files) == 0:
+            return pd.DataFrame(columns=columns or list(map(lambda c: c.name, table.columns)))
+
+        return self._dataset(table, files).to_table(columns=columns, filter=to_expression(criteria)).to_pandas()
+
+    def delete(self, criteria: ff.BinaryOp, table: domain.Table):
+        # The listing up front only picks the partitions to visit. Each partition is listed and pruned again under its
+        # lock, so a compaction can't replace the files we looked at with a master file we never checked.
+        files = self._prune_by_key(table, self._list_table_files(table, criteria), criteria)
+        expression = to_expression(criteria)
+        for partition in sorted(set(map(os.path.dirname, files))):
+            try:
+                with self._mutex(PARTITION_LOCK.format(md5(partition.encode('utf-8')).hexdigest())):
+                    self._delete_from_partition(table, partition, criteria, expression)
+            except TimeoutError:
+                self.info(f'Could not acquire lock for {partition}. Skipping.')
+
+    def _delete_from_partition(self, table: domain.Table, partition: str, criteria: ff.BinaryOp,
+                               expression: ds.Expression):
+        files = self._prune_by_key(table, self._list_files(partition), criteria)
+        if len(files) == 0:
+            return
+
+        dataset = self._dataset(table, files)
+        for fragment in dataset.get_fragments(filter=expression):
+            if fragment.subset(filter=expression, schema=dataset.schema).num_row_groups == 0:
+                continue
+            rows = matching_rows(fragment, dataset.schema, criteria)
+            if len(rows) == 0:
+                continue
+            data = pq.read_table(fragment.path, memory_map=True)
+            if len(rows) == data.num_rows:
+                os.remove(fragment.path)
+                continue
+            mask = np.ones(data.num_rows, dtype=bool)
+            mask[rows] = False
+            self._replace_file(data.filter(pa.array(mask)), fragment.path)
+
+    def get_partitions(self, table: domain.Table, criteria: ff.BinaryOp = None) -> List[str]:
+        fields = partition_fields(table)
+        if len(fields) == 0:
+            return []
+
+        ret = [self._table_path(table)]
+        for _ in fields:
+            children = []
+            for path in ret:
+                try:
+                    entries = list(os.scandir(path))
+                except FileNotFoundError:
+                    continue
+                for entry in entries:
+                    if entry.is_dir() and '=' in entry.name and \
+                            partition_matches(criteria, partition_values(entry.path), table):
+                        children.append(entry.path)
+            ret = children
+
+        return ret
+
+    def get_partitions_to_compact(self, table: domain.Table) -> List[str]:
+        if len(partition_fields(table)) == 0:
+            paths = [self._table_path(table)]
+        else:
+            paths = self.get_partitions(table)
+
+        return [
+            path for path in paths if any(not f.endswith(MASTER_FILE) for f in self._list_files(path))
+        ]
+
+    def get_fingerprint(self, table: domain.Table, criteria: ff.BinaryOp = None) -> str:
+        ret = md5()
+        for file in sorted(self._list_table_files(table, criteria)):
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                continue
+            ret.update(f'{file}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+
+        return ret.hexdigest()
+
+    def wait_for_tmp_files(self, files: list):
+        for _ in range(60):
+            if all(os.path.exists(self._tmp_path(f)) for f in files):
+                return
+            sleep(1)
+
+        raise TimeoutError('Timed out waiting for tmp files')
+
+    def read_tmp_files(self, files: list) -> pd.DataFrame:
+        return ds.dataset(list(map(self._tmp_path, files)), format='parquet', filesystem=self._fs)\
+            .to_table().to_pandas()
+
+    def read_files(self, files: List[str], columns: List[str] = None, criteria: ff.BinaryOp = None) -> pa.Table:
+        paths = list(map(lambda f: self._tmp_path(f.split('://', 1)[-1]), files))
+
+        return ds.dataset(paths, format='parquet', filesystem=self._fs).to_table(
+            columns=columns, filter=to_expression(criteria)
+        )
+
+    def write_tmp_file(self, file: str, data: Union[pd.DataFrame, pa.Table]):
+        path = self._tmp_path(file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(data, pd.DataFrame):
+            data = pa.Table.from_pandas(data, preserve_index=False)
+        pq.write_table(data, path, **PARQUET_OPTIONS)
+
+    def deduplicate_partition(self, table: domain.Table, path: str):
+        if table.duplicate_sort is None or table.duplicate_fields is None:
+            return
+
+        path = self._prepare_path(path)
+        try:
+            with self._mutex(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest())):
+                files = list(filter(lambda f: f.endswith(MASTER_FILE), self._list_files(path)))
+                frames = [
+                    pq.read_table(f, columns=duplicate_columns(table), memory_map=True).to_pandas() for f in files
+                ]
+
+                for i, rows in find_duplicates(frames, table).items():
+                    self.info(f'Filtering {files[i]}')
+                    f = pq.read_table(files[i], memory_map=True)
+                    mask = np.ones(f.num_rows, dtype=bool)
+                    mask[rows] = False
+                    self._replace_file(f.filter(pa.array(mask)), files[i])
+        except TimeoutError:
+            pass
+
+    def compact(self, table: domain.Table, path: str, start: datetime = None):
+        start = start or datetime.now()
+        if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
+            return
+        self.info(f"Compacting {path}")
+        path = self._prepare_path(path)
+        try:
+            with self._mutex(PARTITION_LOCK.format(md5(path.encode('utf-8')).hexdigest()), timeout=0):
+                while True:
+                    objects = [(f, os.path.getsize(f)) for f in self._list_files(path)]
+                    plan = plan_compaction(path, objects, MAX_FILE_SIZE)
+                    if len(plan) == 0:
+                        break  # Nothing new to compact
+                    with ThreadPoolExecutor(max_workers=int(self._compact_concurrency)) as executor:
+                        for future in [executor.submit(self._run_compaction_task, table, task) for task in plan]:
+                            future.result()
+                    if (datetime.now() - start).total_seconds() >= MAX_RUN_TIME:
+                        self.info("We've been running for 10 minutes. Stopping now.")
+                        break
+                self._write_bloom_index(table, path)
+        except TimeoutError:
+            pass  # Another process must be compacting
+
+    def _run_compaction_task(self, table: domain.Table, task: CompactionTask):
+        to_read = task.files.copy()
+        if task.target_exists:
+            to_read.append(task.target)
+
+        if self._compaction_mode == 'streaming':
+            compactor = StreamingCompactor(
+                self._sanitize_input_data, self._remove_duplicates, int(self._compaction_memory_limit)
+            )
+            compactor(table, to_read, f'{task.target}.tmp', self._fs)
+            os.replace(f'{task.target}.tmp', task.target)
+            if table.duplicate_fields:
+                self._write_bloom_filter(
+                    pq.read_table(task.target, columns=table.duplicate_fields, memory_map=True).to_pandas(),
+                    task.target, table
+                )
+        else:
+            df = self._sanitize_input_data(
+                ds.dataset(to_read, format='parquet', filesystem=self._fs).to_table().to_pandas(), table
+            )
+            self._remove_duplicates(df, table)
+            try:
+                df.reset_index(inplace=True)
+            except ValueError:
+                pass
+            self._write_file(df, task.target, table)
+        for file in task.files:
+            os.remove(file)
+            try:
+                os.remove(sidecar_path(file))
+            except FileNotFoundError:
+                pass
+
+        self.info(f'Compacted {len(task.files)} records into {task.target}')
+
+    def _list_table_files(self, table: domain.Table, criteria: ff.BinaryOp = None) -> List[str]:
+        if len(partition_fields(table)) == 0:
+            return self._list_files(self._table_path(table))
+
+        ret = []
+        for partition in self.get_partitions(table, criteria):
+            ret.extend(self._list_files(partition))
+
+        return ret
+
+    def _dataset(self, table: domain.Table, files: List[str]) -> ds.Dataset:
+        return ds.dataset(
+            files, schema=dataset_schema(table), format='parquet', filesystem=self._fs,
+            partitioning=partitioning(table), partition_base_dir=self._table_path(table)
+        )
+
+    def _write_file(self, df: pd.DataFrame, path: str, table: domain.Table):
+        schema = file_schema(table)
+        data = pa.Table.from_pandas(df.reindex(columns=schema.names), schema=schema, preserve_index=False)
+        self._replace_file(data, path)
+        if table.duplicate_fields:
+            self._write_bloom_filter(df, path, table)
+
+    def _write_bloom_filter(self, df: pd.DataFrame, path: str, table: domain.Table):
+        self._replace_bytes(serialize_filter(build_filter(df, table)), sidecar_path(path))
+
+    def _read_bloom_filter(self, path: str) -> Optional[BloomFilter]:
+        try:
+            with open(sidecar_path(path), 'rb') as fp:
+                return deserialize_filter(fp.read())
+        except FileNotFoundError:
+            return None
+
+    def _read_bloom_index(self, path: str) -> dict:
+        try:
+            return deserialize_index(index_path(path))
+        except (FileNotFoundError, OSError):
+            return {}
+
+    def _write_bloom_index(self, table: domain.Table, path: str):
+        if not table.duplicate_fields:
+            return
+
+        masters = [(f, os.path.getsize(f)) for f in self._list_files(path) if f.endswith(MASTER_FILE)]
+        index = merge_index(masters, self._read_bloom_index(path), self._read_bloom_filter)
+        self._replace_bytes(serialize_index(index).to_pybytes(), index_path(path))
+        for file, _ in masters:
+            if os.path.basename(file) in index:
+                try:
+                    os.remove(sidecar_path(file))
+                except FileNotFoundError:
+                    pass
+
+    def _prune_by_key(self, table: domain.Table, files: List[str], criteria: ff.BinaryOp = None) -> List[str]:
+        hashes = lookup_hashes(criteria, table)
+        if hashes is None:
+            return files
+
+        directories = {}
+        for file in files:
+            directories.setdefault(os.path.dirname(file), []).append((file, os.path.getsize(file)))
+
+        ret = []
+        for directory, objects in directories.items():
+            ret.extend(prune_files(objects, hashes, self._read_bloom_index(directory), self._read_bloom_filter))
+
+        return ret
+
+    @staticmethod
+    def _replace_bytes(data: bytes, path: str):
+        with open(f'{path}.tmp', 'wb') as fp:
+            fp.write(data)
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def _replace_file(data: pa.Table, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(data, f'{path}.tmp', **PARQUET_OPTIONS)
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def _list_files(path: str) -> List[str]:
+        try:
+            return sorted(
+                entry.path for entry in os.scandir(path) if entry.is_file() and entry.name.endswith('.parquet')
+            )
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _partition_value(value):
+        if pd.isna(value):
+            return '__HIVE_DEFAULT_PARTITION__'
+        return value
+
+    def _table_path(self, table: domain.Table):
+        return os.path.join(self._local_data_path, table.full_path().lstrip('/'))
+
+    def _tmp_path(self, file: str):
+        return os.path.join(self._local_data_path, file.lstrip('/'))
+
+    def _prepare_path(self, path: str):
+        path = path.rstrip('/')
+        if path.startswith('s3://'):
+            path = path[len('s3://'):]
+        if not path.startswith(self._local_data_path):
+            path = os.path.join(self._local_data_path, path.lstrip('/'))
+
+        return path
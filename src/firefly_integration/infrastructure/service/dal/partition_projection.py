@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from datetime import datetime
+from itertools import product
+from typing import List, Optional
+
+import firefly as ff
+import pandas as pd
+
+import firefly_integration.domain as domain
+from .arrow_criteria import partition_fields, partition_matches
+
+JAVA_DATE_FORMATS = {'%Y': 'yyyy', '%m': 'MM', '%d': 'dd'}
+INTERVAL_UNITS = {'year': 'YEARS', 'month': 'MONTHS', 'day': 'DAYS'}
+PERIODS = {'year': 'Y', 'month': 'M', 'day': 'D'}
+
+
+def projection_parameters(table: domain.Table, location: str) -> dict:
+    """
+    Glue table parameters that let Athena compute a table's partitions from its definition instead of looking them up.
+    Rows with a null partition value (__HIVE_DEFAULT_PARTITION__) are not visible to projected queries.
+    """
+    if not table.projection_enabled:
+        return {'projection.enabled': 'false'}
+
+    ret = {'projection.enabled': 'true'}
+    for name in partition_fields(table):
+        if name == 'dt':
+            ret.update({
+                'projection.dt.type': 'date',
+                'projection.dt.format': _java_format(table.time_partition_format),
+                'projection.dt.range': f'{_format_start(table)},NOW',
+                'projection.dt.interval': '1',
+                'projection.dt.interval.unit': INTERVAL_UNITS.get(table.time_partitioning, 'YEARS'),
+            })
+            continue
+
+        values = table.projected_partition_values(name)
+        if isinstance(values, range) and values.step == 1:
+            ret[f'projection.{name}.type'] = 'integer'
+            ret[f'projection.{name}.range'] = f'{values.start},{values.stop - 1}'
+        else:
+            ret[f'projection.{name}.type'] = 'enum'
+            ret[f'projection.{name}.values'] = ','.join(map(str, values))
+
+    template = '/'.join(f'{name}=${{{name}}}' for name in partition_fields(table))
+    ret['storage.location.template'] = f'{location.rstrip("/")}/{template}'
+
+    return ret
+
+
+def enumerate_partitions(table: domain.Table, criteria: Optional[ff.BinaryOp] = None) -> List[str]:
+    """
+    Lists a projected table's partitions (relative hive paths) from its definition, without a catalog call. Each
+    partition's values are pruned against the criteria on their own before the combinations are built.
+    """
+    fields = partition_fields(table)
+    axes = []
+    for name in fields:
+        values = _time_periods(table) if name == 'dt' else list(map(str, table.projected_partition_values(name)))
+        axes.append([v for v in values if partition_matches(criteria, {name: v}, table)])
+
+    ret = []
+    for values in product(*axes):
+        if partition_matches(criteria, dict(zip(fields, values)), table):
+            ret.append('/'.join(f'{k}={v}' for k, v in zip(fields, values)))
+
+    return ret
+
+
+def _time_periods(table: domain.Table) -> List[str]:
+    periods = pd.period_range(
+        pd.Timestamp(table.time_partitioning_start), datetime.utcnow(), freq=PERIODS.get(table.time_partitioning, 'Y')
+    )
+
+    return list(periods.strftime(table.time_partition_format))
+
+
+def _format_start(table: domain.Table) -> str:
+    return pd.Timestamp(table.time_partitioning_start).strftime(table.time_partition_format)
+
+
+def _java_format(fmt: str) -> str:
+    for k, v in JAVA_DATE_FORMATS.items():
+        fmt = fmt.replace(k, v)
+
+    return fmt
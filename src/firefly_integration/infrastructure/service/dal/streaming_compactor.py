@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import math
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs as fs
+import pyarrow.parquet as pq
+
+import firefly_integration.domain as domain
+from .arrow_criteria import file_schema
+from .arrow_writer import PARQUET_OPTIONS
+
+BATCH_SIZE = 65536
+EXPANSION_FACTOR = 5  # Rough ratio of in-memory size to compressed parquet size
+
+
+class StreamingCompactor:
+    """
+    Merges parquet files into a single file while holding only a bounded amount of data in memory. Inputs are read
+    one batch at a time and sanitized as they go. When the table has duplicate_fields, rows are spilled to local
+    buckets by a hash of the key, so every copy of a key lands in the same bucket. Each bucket is small enough to
+    de-duplicate in memory, and is then appended to the output through an incremental writer.
+    """
+
+    def __init__(self, sanitize_input_data: domain.SanitizeInputData, remove_duplicates: domain.RemoveDuplicates,
+                 memory_limit: int):
+        self._sanitize_input_data = sanitize_input_data
+        self._remove_duplicates = remove_duplicates
+        self._memory_limit = memory_limit
+
+    def __call__(self, table: domain.Table, inputs: List[str], output: str, filesystem: fs.FileSystem):
+        schema = file_schema(table)
+
+        with filesystem.open_output_stream(output) as sink:
+            with pq.ParquetWriter(where=sink, schema=schema, **PARQUET_OPTIONS) as writer:
+                if not table.duplicate_fields:
+                    for batch in self._read(table, inputs, filesystem, schema):
+                        writer.write_table(batch)
+                    return
+
+                with tempfile.TemporaryDirectory() as tmp:
+                    buckets = self._spill(table, inputs, filesystem, schema, tmp)
+                    for bucket in buckets:
+                        df = pq.read_table(bucket).to_pandas()
+                        os.remove(bucket)
+                        self._remove_duplicates(df, table)
+                        writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+    def _spill(self, table: domain.Table, inputs: List[str], filesystem: fs.FileSystem, schema: pa.Schema,
+               tmp: str) -> List[str]:
+        size = sum(map(lambda f: f.size, filesystem.get_file_info(inputs)))
+        num_buckets = max(1, math.ceil(size * EXPANSION_FACTOR / self._memory_limit))
+        paths = [os.path.join(tmp, f'{i}.parquet') for i in range(num_buckets)]
+        writers = {}
+
+        try:
+            for batch in self._read(table, inputs, filesystem, schema):
+                keys = batch.select(table.duplicate_fields).to_pandas()
+                codes = pd.util.hash_pandas_object(keys, index=False).values % num_buckets
+                for code in np.unique(codes):
+                    if code not in writers:
+                        writers[code] = pq.ParquetWriter(where=paths[code], schema=schema)
+                    writers[code].write_table(batch.take(pa.array(np.flatnonzero(codes == code))))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        return [paths[code] for code in sorted(writers.keys())]
+
+    def _read(self, table: domain.Table, inputs: List[str], filesystem: fs.FileSystem, schema: pa.Schema):
+        for path in inputs:
+            with filesystem.open_input_file(path) as source:
+                for batch in pq.ParquetFile(source).iter_batches(batch_size=BATCH_SIZE):
+                    df = self._sanitize_input_data(batch.to_pandas(), table)
+                    yield pa.Table.from_pandas(df.reindex(columns=schema.names), schema=schema, preserve_index=False)